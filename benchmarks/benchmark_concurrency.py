@@ -0,0 +1,95 @@
+"""
+Compare the adaptive concurrency controller with the fixed pool of 15 processes it replaced.
+
+The upstream servers are simulated: each host has a latency and a capacity, and answers
+with HTTP 429 when more requests than its capacity are in flight, after which the client
+has to wait before retrying.
+
+Run with
+    python benchmarks/benchmark_concurrency.py
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from concurrency import ConcurrencyController, request_slot, adaptive_map  # noqa: E402
+
+# Host name: (latency in seconds, number of requests handled concurrently before throttling).
+SIMULATED_HOSTS = {
+    "api.crossref.org": (0.05, 64),
+    "export.arxiv.org": (0.2, 4),
+}
+RETRY_AFTER = 0.5
+# Fraction of the references that are looked up on the arXiv.
+ARXIV_FRACTION = 0.1
+
+in_flight = None
+
+
+def initialize_server(shared_in_flight):
+    global in_flight
+    in_flight = shared_in_flight
+
+
+def simulated_request(host):
+    """Perform a single request to a simulated host, returning False if the request was throttled."""
+    index = list(SIMULATED_HOSTS).index(host)
+    latency, capacity = SIMULATED_HOSTS[host]
+    with in_flight.get_lock():
+        in_flight[index] += 1
+        throttled = in_flight[index] > capacity
+    time.sleep(latency / 5 if throttled else latency)
+    with in_flight.get_lock():
+        in_flight[index] -= 1
+    return not throttled
+
+
+def fixed_pool_lookup(host):
+    while not simulated_request(host):
+        time.sleep(RETRY_AFTER)
+
+
+def adaptive_lookup(host, controller):
+    while True:
+        with request_slot(f"https://{host}/", controller) as outcome:
+            succes = simulated_request(host)
+            if not succes:
+                outcome.failed(429)
+        if succes:
+            return
+        time.sleep(RETRY_AFTER)
+
+
+def make_input(number_of_references):
+    number_of_arxiv_references = int(number_of_references * ARXIV_FRACTION)
+    return ["export.arxiv.org"] * number_of_arxiv_references + ["api.crossref.org"] * (number_of_references - number_of_arxiv_references)
+
+
+def benchmark_fixed_pool(hosts):
+    shared_in_flight = multiprocessing.Array("i", len(SIMULATED_HOSTS))
+    start = time.perf_counter()
+    with multiprocessing.Pool(15, initializer=initialize_server, initargs=(shared_in_flight,)) as pool:
+        pool.map(fixed_pool_lookup, hosts)
+    return time.perf_counter() - start
+
+
+def benchmark_adaptive(hosts):
+    initialize_server(multiprocessing.Array("i", len(SIMULATED_HOSTS)))
+    controller = ConcurrencyController()
+    start = time.perf_counter()
+    adaptive_map(lambda host: adaptive_lookup(host, controller), hosts, controller)
+    duration = time.perf_counter() - start
+    return duration, controller
+
+
+if __name__ == "__main__":
+    for number_of_references in [5, 1000]:
+        hosts = make_input(number_of_references)
+        fixed_pool_duration = benchmark_fixed_pool(hosts)
+        adaptive_duration, controller = benchmark_adaptive(hosts)
+        print(f"{number_of_references} references: fixed pool {fixed_pool_duration:.2f} s, adaptive {adaptive_duration:.2f} s")
+        print(controller.report())
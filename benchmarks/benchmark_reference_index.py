@@ -0,0 +1,80 @@
+"""
+Measure the time to match free text references against a large ReferenceIndex.
+
+The index file is filled with synthetic records, with title words drawn from a Zipf-like
+distribution, opened again, and queried with free text versions of some of the records.
+
+Run with
+    python benchmarks/benchmark_reference_index.py [number_of_records]
+"""
+
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reference_index import ReferenceIndex, MATCH_THRESHOLD  # noqa: E402
+
+# Number of records added to the index in a single transaction.
+BATCH_SIZE = 10000
+
+JOURNALS = [("Physical Review B", "Phys. Rev. B"), ("Physical Review Letters", "Phys. Rev. Lett."),
+            ("Nuclear Physics B", "Nucl. Phys. B"), ("SciPost Physics", "SciPost Phys."),
+            ("Journal of High Energy Physics", "J. High Energ. Phys.")]
+
+
+def make_word(random_generator):
+    return "".join(random_generator.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(random_generator.randint(4, 10)))
+
+
+def make_records(number_of_records, seed=0):
+    random_generator = random.Random(seed)
+    vocabulary = [make_word(random_generator) for _ in range(50000)]
+    surnames = [make_word(random_generator).capitalize() for _ in range(100000)]
+    # Zipf-like weights, so some title words are very common.
+    cumulative_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    for i in range(number_of_records):
+        journal, short_journal = random_generator.choice(JOURNALS)
+        yield {"doi": f"10.1234/synthetic.{i}",
+               "arxiv_id": None,
+               "title": " ".join(random_generator.choices(vocabulary, cum_weights=cumulative_weights, k=random_generator.randint(4, 12))),
+               "first_author": random_generator.choice(surnames),
+               "journal": journal,
+               "short_journal": short_journal,
+               "volume": str(random_generator.randint(1, 120)),
+               "page": str(random_generator.randint(1, 999999)),
+               "year": random_generator.randint(1950, 2024)}
+
+
+def free_text(record):
+    return (f"A. {record['first_author']}, {{``{record['title'].capitalize()}''}}, "
+            f"{record['short_journal']} {{\\bf {record['volume']}}}, {record['page']} ({record['year']}).")
+
+
+if __name__ == "__main__":
+    number_of_records = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    records = list(make_records(number_of_records))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_file = os.path.join(temp_dir, "index.sqlite")
+        reference_index = ReferenceIndex(index_file)
+        start = time.perf_counter()
+        for batch_start in range(0, len(records), BATCH_SIZE):
+            reference_index.add_records(records[batch_start:batch_start + BATCH_SIZE])
+        print(f"Indexed {len(reference_index)} records in {time.perf_counter() - start:.1f} s")
+        reference_index.close()
+        start = time.perf_counter()
+        reference_index = ReferenceIndex(index_file)
+        print(f"Opened the index in {(time.perf_counter() - start) * 1000:.1f} ms")
+        queries = random.Random(1).sample(records, 1000)
+        start = time.perf_counter()
+        matches = 0
+        for record in queries:
+            match, confidence = reference_index.search(free_text(record))
+            matches += match == record and confidence >= MATCH_THRESHOLD
+        duration = time.perf_counter() - start
+        print(f"{len(queries)} lookups: {duration / len(queries) * 1000:.3f} ms per lookup, {matches} correct matches")
+        reference_index.close()
@@ -0,0 +1,38 @@
+"""
+Compare the bibitem and arXiv id scanners with the regular expressions they replaced, on pathological input.
+
+The regular expressions take time quadratic in the length of the input, the scanners linear time.
+
+Run with
+    python benchmarks/benchmark_scanners.py [largest_input_size]
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reference_utils import extract_bibtex_items, extract_arxiv_ids  # noqa: E402
+
+OLD_BIBTEX_ITEM_REGEX = re.compile(r"(?<!%)(\\bibitem{.*?}.+?)(?=\\bibitem{|\\end{thebibliography}|$)", re.DOTALL)
+OLD_ARXIV_ID_REGEX = re.compile(r"abs\/(.*?)(?=\ |}|$)|arxiv:(.*?)(?=\ |}|$|])|\\eprint{(.*?)}", re.IGNORECASE)
+# Name, repeated piece of text, old and new scanner.
+CASES = [("unterminated bibitems", "\\bibitem{", OLD_BIBTEX_ITEM_REGEX.findall, extract_bibtex_items),
+         ("repeated urls", "abs/", OLD_ARXIV_ID_REGEX.findall, extract_arxiv_ids)]
+
+
+def measure(scanner, text):
+    start = time.perf_counter()
+    scanner(text)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    largest_input_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, piece, old_scanner, new_scanner in CASES:
+        for input_size in [largest_input_size // 10, largest_input_size // 3, largest_input_size]:
+            text = piece * (input_size // len(piece)) + "\nx"
+            print(f"{name}, {input_size} characters: regular expression {measure(old_scanner, text):.3f} s, "
+                  f"scanner {measure(new_scanner, text):.3f} s")
@@ -0,0 +1,300 @@
+"""Utilities to read the cited references from BibTeX databases (.bib) and generated bibliographies (.bbl)."""
+
+import re
+import warnings
+
+from latex_utils import next_occurrence_finder
+from reference_utils import BIBITEM_COMMAND, concatenate_authors, extract_bibitem_identifier
+
+# BibTeX entry types which do not describe a reference.
+NON_REFERENCE_TYPES = [b"comment", b"preamble", b"string"]
+ENTRY_START_REGEX = re.compile(rb"^\s*@\s*(\w+)\s*{\s*([^,\s{}]+)\s*,")
+FIELD_NAME_REGEX = re.compile(r"[\s,]*([\w\-:.]+)\s*=\s*")
+# Any citation command, e.g. \cite, \citep, \nocite.
+CITE_COMMAND_REGEX = re.compile(r"\\(?:no)?cite[a-zA-Z]*\*?")
+BARE_VALUE_REGEX = re.compile(r"[^\s,#}]*")
+CONCATENATION_REGEX = re.compile(r"\s*#\s*")
+# Characters which matter for the end of a natbib label: braces and brackets, and escaped characters.
+LABEL_CHARACTER_REGEX = re.compile(r"\\.?|[{}\]]", re.DOTALL)
+# Longest \bibitem command with a natbib label (\bibitem[label]{key}) in a .bbl file which is recognized.
+MAX_LABEL_LENGTH = 1000
+
+
+def decode(data):
+    """Decode bytes read from a bibliography file, in the same way as read_latex_file."""
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
+
+
+def extract_citation_keys(latex_source):
+    """Extract the keys of all cited references in a LaTeX source, in order of first citation."""
+    # Remove comments, but not escaped percent signs.
+    latex_source = re.sub(r"(?<!\\)%.*", "", latex_source)
+    find = next_occurrence_finder(latex_source)
+    keys = {}
+    position = 0
+    while True:
+        command = CITE_COMMAND_REGEX.search(latex_source, position)
+        if not command:
+            return list(keys)
+        position = skip_whitespace(latex_source, command.end())
+        # Optional pre- and postnotes.
+        for _ in range(2):
+            if not latex_source.startswith("[", position):
+                break
+            end_of_note = find("]", position)
+            if end_of_note == len(latex_source):
+                break
+            position = skip_whitespace(latex_source, end_of_note + 1)
+        closing = find("}", position)
+        if not latex_source.startswith("{", position) or closing == len(latex_source):
+            position = command.end()
+            continue
+        for key in latex_source[position + 1:closing].split(","):
+            key = key.strip()
+            if key:
+                keys.setdefault(key, None)
+        position = closing + 1
+
+
+def skip_whitespace(text, position):
+    """Return the position of the first character at or after position which is not whitespace."""
+    while position < len(text) and text[position].isspace():
+        position += 1
+    return position
+
+
+def index_bib_file(bib_file):
+    """
+    Index the entries of a .bib file by key, without reading the whole file into memory.
+
+    Returns a dictionary mapping every key to the byte offset and length of its entry.
+    An entry with unbalanced braces ends where the next entry starts (or at the end of the file), with a warning.
+    """
+    index = {}
+    with open(bib_file, "rb") as data:
+        offset = 0
+        key = None
+        for line in data:
+            match = ENTRY_START_REGEX.match(line)
+            if match and key is not None:
+                warnings.warn(f"The braces of entry {key} in {bib_file} are unbalanced.")
+                index[key] = (entry_start, offset - entry_start)
+                key = None
+            if key is None and match and match.group(1).lower() not in NON_REFERENCE_TYPES:
+                key = decode(match.group(2))
+                entry_start = offset
+                depth = 0
+            if key is not None:
+                depth += line.count(b"{") - line.count(b"\\{") - line.count(b"}") + line.count(b"\\}")
+                if depth <= 0:
+                    index[key] = (entry_start, offset + len(line) - entry_start)
+                    key = None
+            offset += len(line)
+    if key is not None:
+        warnings.warn(f"The braces of entry {key} in {bib_file} are unbalanced.")
+        index[key] = (entry_start, offset - entry_start)
+    return index
+
+
+def read_bib_entries(bib_file, index, keys):
+    """Read only the entries with the given keys from an indexed .bib file."""
+    entries = {}
+    with open(bib_file, "rb") as data:
+        for key in keys:
+            if key in index:
+                offset, length = index[key]
+                data.seek(offset)
+                entries[key] = decode(data.read(length))
+    return entries
+
+
+def read_bib_value(entry, position):
+    """Read a (possibly concatenated) field value starting at position, returning the value and the position after it."""
+    value = ""
+    while position < len(entry):
+        character = entry[position]
+        if character in "{\"":
+            closing_character = "}" if character == "{" else "\""
+            depth = 0
+            start = position + 1
+            position += 1
+            while position < len(entry) and not (entry[position] == closing_character and depth == 0):
+                if entry[position] == "{":
+                    depth += 1
+                elif entry[position] == "}":
+                    depth -= 1
+                position += 1
+            value += entry[start:position]
+            position += 1
+        else:
+            # Bare numbers and @string macros.
+            match = BARE_VALUE_REGEX.match(entry, position)
+            value += match.group()
+            position = match.end()
+        concatenation = CONCATENATION_REGEX.match(entry, position)
+        if not concatenation:
+            break
+        position = concatenation.end()
+    return re.sub(r"\s+", " ", value).strip(), position
+
+
+def parse_bib_entry(entry):
+    """Parse a BibTeX entry into its type, key and a dictionary of fields with lower case names."""
+    match = ENTRY_START_REGEX.match(entry.encode("utf-8"))
+    entry_type, key = decode(match.group(1)).lower(), decode(match.group(2))
+    fields = {}
+    position = entry.index(",") + 1
+    while True:
+        field = FIELD_NAME_REGEX.match(entry, position)
+        if not field:
+            break
+        fields[field.group(1).lower()], position = read_bib_value(entry, field.end())
+    return entry_type, key, fields
+
+
+def format_bib_name(name):
+    """Change a BibTeX name of the form 'Last, First' to 'First Last'."""
+    if "," in name:
+        last_name, first_name = name.split(",", 1)
+        name = f"{first_name.strip()} {last_name.strip()}"
+    return re.sub(r"[{}]", "", name).strip()
+
+
+def bib_entry_to_bibitem(entry):
+    """Write a BibTeX entry as a bibitem, so it can be processed in the same way as bibitems in a LaTeX file."""
+    entry_type, key, fields = parse_bib_entry(entry)
+    parts = []
+    if "author" in fields:
+        parts.append(concatenate_authors([format_bib_name(name) for name in re.split(r"\s+and\s+", fields["author"])]))
+    if "title" in fields:
+        parts.append(f"\\textit{{{fields['title']}}}")
+    journal = " ".join(part for part in [fields.get("journal", fields.get("booktitle")),
+                                         f"\\textbf{{{fields['volume']}}}" if "volume" in fields else None] if part)
+    if journal:
+        parts.append(journal)
+    if "publisher" in fields:
+        parts.append(fields["publisher"])
+    if "pages" in fields:
+        parts.append(fields["pages"])
+    bibitem = ", ".join(parts)
+    if "year" in fields:
+        bibitem += f" ({fields['year']})"
+    if "doi" in fields:
+        bibitem += f", \\doi{{{fields['doi']}}}"
+    if "eprint" in fields and fields.get("archiveprefix", "arxiv").lower() == "arxiv":
+        bibitem += f", arXiv:{fields['eprint']}"
+    return f"\\bibitem{{{key}}} {bibitem}."
+
+
+def parse_bbl_bibitem_command(text, start, state=None):
+    """
+    Parse the \\bibitem command at start of text, e.g. \\bibitem [{Abadi et~al.(2016)Abadi, \\dots}]{abadi2016}.
+
+    Whitespace is allowed before the optional label and the key, and the label may contain braces and line breaks.
+    Returns the end and key of the command and None. If there is no command at start, the key is None and the end
+    is where the next command can be looked for. If text ends before the command does, the end and key are None,
+    and the third value is the state with which the parse continues when it is called again with more text, so
+    every character of a label is only scanned once. Commands longer than MAX_LABEL_LENGTH are not recognized.
+    """
+    limit = start + MAX_LABEL_LENGTH
+    # How far the command has been parsed, the brace depth in the label (None outside it), and whether the label was read.
+    offset, depth, label_read = state or (len(BIBITEM_COMMAND), None, False)
+    position = start + offset
+    if depth is None:
+        position = skip_whitespace(text, position)
+        if not label_read and text.startswith("[", position):
+            position, depth = position + 1, 0
+    if depth is not None:
+        # The label ends at the first closing bracket outside braces.
+        while True:
+            match = LABEL_CHARACTER_REGEX.search(text, position, limit)
+            if match is None:
+                if len(text) >= limit:
+                    return limit, None, None
+                return None, None, (len(text) - start, depth, False)
+            position = match.end()
+            if match.group() == "{":
+                depth += 1
+            elif match.group() == "}":
+                depth -= 1
+            elif match.group() == "]" and depth <= 0:
+                break
+        label_read = True
+        position = skip_whitespace(text, position)
+    if position >= len(text):
+        return None, None, (position - start, None, label_read)
+    if not text.startswith("{", position):
+        return position, None, None
+    closing = text.find("}", position, limit)
+    if closing == -1:
+        return (limit, None, None) if len(text) >= limit else (None, None, (position - start, None, label_read))
+    return closing + 1, text[position + 1:closing].strip(), None
+
+
+def iter_bbl_bibitems(bbl_file):
+    """
+    Yield the bibitems in a .bbl file one at a time, reading the file line by line and skipping comment lines.
+
+    A \\bibitem command whose label is wrapped onto the next lines is read up to its key.
+    """
+    bibitem = None
+    # The text read so far of a \bibitem command which continues on the next line, and the state of its parse.
+    command, state = "", None
+    with open(bbl_file, "rb") as data:
+        for line in data:
+            line = decode(line)
+            if line.lstrip().startswith("%"):
+                continue
+            start = 0 if command else line.find(BIBITEM_COMMAND)
+            line = command + line
+            command = ""
+            while start != -1:
+                end, key, state = parse_bbl_bibitem_command(line, start, state)
+                if key is not None or state is not None:
+                    break
+                start = line.find(BIBITEM_COMMAND, end)
+            if state is not None:
+                command = line[start:]
+                continue
+            end_of_bibliography = "\\end{thebibliography}" in line
+            if start != -1 or end_of_bibliography:
+                if bibitem is not None:
+                    yield bibitem
+                    bibitem = None
+                if end_of_bibliography:
+                    continue
+                # Remove the optional natbib label, which the other tools do not expect.
+                bibitem = f"\\bibitem{{{key}}}{line[end:]}"
+            elif bibitem is not None:
+                bibitem += line
+    if command:
+        bibitem = (bibitem or "") + command
+    if bibitem is not None:
+        yield bibitem
+
+
+def read_cited_bibitems(bibliography_file, latex_source):
+    """
+    Read the bibitems of all references cited in a LaTeX source from a .bib or .bbl file.
+
+    Only the cited entries are read (and parsed) from the file. Bibitems from a .bib file are
+    returned in order of first citation, those from a .bbl file in the order of the file.
+    Returns the bibitems and the keys of cited references which are not in the file.
+    """
+    keys = extract_citation_keys(latex_source)
+    cited_keys = set(keys)
+    if bibliography_file.endswith(".bbl"):
+        bibitems = {}
+        for bibitem in iter_bbl_bibitems(bibliography_file):
+            key = extract_bibitem_identifier(bibitem)
+            if "*" in cited_keys or key in cited_keys:
+                bibitems[key] = bibitem
+        return list(bibitems.values()), [key for key in keys if key != "*" and key not in bibitems]
+    index = index_bib_file(bibliography_file)
+    if "*" in cited_keys:
+        keys = [key for key in keys if key != "*"] + [key for key in index if key not in cited_keys]
+    entries = read_bib_entries(bibliography_file, index, keys)
+    return [bib_entry_to_bibitem(entries[key]) for key in keys if key in entries], [key for key in keys if key not in entries]
@@ -0,0 +1,267 @@
+"""Adaptive concurrency control for looking up references on upstream servers."""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# Initial and maximum number of concurrent requests per host.
+# arXiv asks API users to be gentle, while Crossref comfortably handles many parallel requests.
+HOST_LIMITS = {
+    "api.crossref.org": (8, 48),
+    "export.arxiv.org": (2, 4),
+}
+DEFAULT_HOST_LIMITS = (4, 16)
+# Responses slower than this (in seconds) are taken as a sign that the host is getting overloaded.
+TARGET_LATENCY = 2.0
+# Inputs of this size or smaller are processed inline, since there is nothing to overlap.
+INLINE_THRESHOLD = 1
+# Maximum time (in seconds) to wait for a single response.
+REQUEST_TIMEOUT = 20
+# Requests slower than this percentile of the host's latencies are hedged with a duplicate request.
+HEDGE_PERCENTILE = 95
+# Number of latencies that have to be observed for a host before requests are hedged.
+HEDGE_MIN_SAMPLES = 20
+
+
+def get_host(address):
+    """Return the host name of a web address."""
+    return urlsplit(address).hostname or address
+
+
+class HostLimiter:
+    """
+    Limit the number of concurrent requests to a single host.
+
+    The limit is adjusted AIMD-style: every fast successful response increases the limit
+    by 1/limit (so by roughly one per round of requests), while errors, throttling (HTTP 429)
+    and slow responses cut it multiplicatively. The limit is cut once per congestion event:
+    responses to requests which were sent before the last cut do not cut it again.
+    """
+    def __init__(self, host, initial_limit, max_limit, min_limit=1, target_latency=TARGET_LATENCY):
+        self.host = host
+        self.limit = float(initial_limit)
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.latencies = deque(maxlen=200)
+        self.last_decrease = float("-inf")
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Wait until a request to the host is allowed, returning False if this took longer than the timeout."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, error=False, throttled=False, started=None):
+        """
+        Record the outcome of a request and adjust the concurrency limit.
+
+        started is the (monotonic) time at which the request was sent. Without it, the
+        request is taken to be sent after the last cut of the limit.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.requests += 1
+            if throttled:
+                self.throttled += 1
+                self.decrease(0.5, started)
+            elif error:
+                self.errors += 1
+                self.decrease(0.75, started)
+            else:
+                self.latencies.append(latency)
+                if latency > self.target_latency:
+                    self.decrease(0.9, started)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def cancel(self):
+        """Free the slot of a request which was not sent after all, without recording an outcome."""
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def decrease(self, factor, started):
+        """Cut the limit by a factor, unless it was already cut after the request was sent (the caller holds the condition)."""
+        if started is not None and started < self.last_decrease:
+            return
+        self.limit = max(self.min_limit, self.limit * factor)
+        self.last_decrease = time.monotonic()
+
+    def latency_percentile(self, percentile):
+        """Return a percentile (between 0 and 100) of the observed latencies, or None if nothing was observed."""
+        with self.condition:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+    def hedge_delay(self):
+        """Return the time after which a request to the host should be hedged, or None if too little is known about the host."""
+        with self.condition:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+        return self.latency_percentile(HEDGE_PERCENTILE)
+
+    def report(self):
+        """Summarize the current state of the limiter."""
+        median_latency = self.latency_percentile(50)
+        median_latency = f"{median_latency:.2f} s" if median_latency is not None else "n/a"
+        return (f"{self.host}: limit {int(self.limit)} (max {self.max_limit}), {self.requests} requests, "
+                f"{self.errors} errors, {self.throttled} throttled, median latency {median_latency}")
+
+
+class ConcurrencyController:
+    """Keep track of a HostLimiter for every upstream host."""
+    def __init__(self, host_limits=None, default_host_limits=DEFAULT_HOST_LIMITS):
+        self.host_limits = HOST_LIMITS if host_limits is None else host_limits
+        self.default_host_limits = default_host_limits
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def limiter(self, address):
+        """Return the limiter for the host of a web address."""
+        host = get_host(address)
+        with self.lock:
+            if host not in self.limiters:
+                initial_limit, max_limit = self.host_limits.get(host, self.default_host_limits)
+                self.limiters[host] = HostLimiter(host, initial_limit, max_limit)
+            return self.limiters[host]
+
+    def max_workers(self):
+        """Return the largest number of requests which can ever be in flight at the same time."""
+        return sum(max_limit for _, max_limit in self.host_limits.values()) + self.default_host_limits[1]
+
+    def limits(self):
+        """Return the current concurrency limit for every host that has been contacted."""
+        with self.lock:
+            return {host: int(limiter.limit) for host, limiter in self.limiters.items()}
+
+    def report(self):
+        """Summarize the state of all hosts that have been contacted."""
+        with self.lock:
+            limiters = list(self.limiters.values())
+        return "\n".join(limiter.report() for limiter in limiters)
+
+
+class Deadline:
+    """A deadline for a complete run, from which the time available to each request is derived."""
+    def __init__(self, seconds):
+        self.end = time.monotonic() + seconds
+
+    def remaining(self):
+        """Return the time left (in seconds) before the deadline."""
+        return max(0, self.end - time.monotonic())
+
+    def expired(self):
+        return self.remaining() == 0
+
+    def timeout(self):
+        """Return the time a single request may take, which shrinks as the deadline approaches."""
+        return min(REQUEST_TIMEOUT, self.remaining())
+
+
+class RequestOutcome:
+    """The outcome of a single request, as recorded by the code performing it."""
+    def __init__(self):
+        self.error = False
+        self.throttled = False
+        self.sent = True
+
+    def failed(self, status_code=None):
+        self.error = True
+        self.throttled = status_code == 429
+
+    def not_sent(self):
+        """Record that no request was sent after all, e.g. because there was no time left."""
+        self.sent = False
+
+
+CONTROLLER = ConcurrencyController()
+
+
+@contextmanager
+def request_slot(address, controller=None, timeout=None):
+    """
+    Wait for a free request slot for the host of an address, and record the request outcome afterwards.
+
+    Raises a TimeoutError if no slot became available within the timeout.
+    """
+    limiter = (controller or CONTROLLER).limiter(address)
+    if not limiter.acquire(timeout):
+        raise TimeoutError(f"No request slot for {limiter.host} became available in time.")
+    outcome = RequestOutcome()
+    start = time.monotonic()
+    try:
+        yield outcome
+    finally:
+        if outcome.sent:
+            limiter.release(time.monotonic() - start, error=outcome.error, throttled=outcome.throttled, started=start)
+        else:
+            limiter.cancel()
+
+
+def adaptive_map(function, items, controller=None, inline_threshold=INLINE_THRESHOLD):
+    """
+    Apply a function to all items, overlapping the upstream requests made by the function.
+
+    The actual number of concurrent requests is limited per host by the controller,
+    so the number of worker threads only has to be an upper bound.
+    """
+    items = list(items)
+    if len(items) <= inline_threshold:
+        return [function(item) for item in items]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(len(items), (controller or CONTROLLER).max_workers())) as executor:
+        return list(executor.map(function, items))
+
+
+def adaptive_imap_unordered(function, items, controller=None, inline_threshold=INLINE_THRESHOLD):
+    """Like adaptive_map, but yield the results as soon as they are available, in order of completion."""
+    items = list(items)
+    if len(items) <= inline_threshold:
+        for item in items:
+            yield function(item)
+        return
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    with ThreadPoolExecutor(max_workers=min(len(items), (controller or CONTROLLER).max_workers())) as executor:
+        for future in as_completed([executor.submit(function, item) for item in items]):
+            yield future.result()
+
+
+def hedged_call(function, hedge_delay):
+    """
+    Call a function, and call it a second time if it has not returned after hedge_delay seconds.
+
+    The function is called with an event, which is set once a result has been returned, so the slower call
+    can be called off (e.g. if it is still waiting for a request slot). The result of the first successful
+    call is returned. If both calls fail, the exception of the first call is raised.
+    """
+    finished = threading.Event()
+    if hedge_delay is None:
+        return function(finished)
+    from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        futures = [executor.submit(function, finished)]
+        done, _ = wait(futures, timeout=hedge_delay)
+        if not done:
+            futures.append(executor.submit(function, finished))
+        for future in as_completed(futures):
+            if future.exception() is None:
+                return future.result()
+        return futures[0].result()
+    finally:
+        # Call off the slower of the two calls, without waiting for it.
+        finished.set()
+        executor.shutdown(wait=False)
@@ -0,0 +1,294 @@
+"""
+A durable queue of reference lookups in an SQLite database, shared by any number of worker processes.
+
+The workers can run on several hosts, as long as they share a filesystem with working file locks.
+A coordinator (the reference formatter or scraper with --queue) adds the bibitems to the queue and waits for
+the records of the looked up references. Workers lease jobs for a limited time, so the jobs of a crashed
+worker are retried by the others, and give up on a job after a number of attempts.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from concurrency import Deadline
+from reference_index import ReferenceIndex
+from reference_utils import Reference
+
+# Time (in seconds) a worker has to look up a reference, after which its lease expires and another worker can claim it.
+LEASE_DURATION = 300
+# Number of times a job is tried before it is given up on.
+MAX_ATTEMPTS = 3
+# Time (in seconds) before a job which failed is retried.
+RETRY_DELAY = 30
+# Time (in seconds) between checks of the queue by idle workers and by the coordinator.
+POLL_INTERVAL = 1
+# Time (in seconds) to wait for another process to release its lock on the database.
+LOCK_TIMEOUT = 60
+# Statuses of looked up references for which the lookup is retried, if a request failed on a transient error
+# (a timeout, connection error, throttling or server error). Other errors, e.g. an unknown DOI, are not retried.
+RETRY_STATUSES = ["failed", "partially_resolved"]
+# Maximum number of job ids in a single query.
+QUERY_SIZE = 500
+
+# A job is "pending" until it is claimed by a worker, "leased" while the worker looks it up, and then
+# "done" (with the record as its result) or "failed". For pending jobs, available_at is the time from
+# which the job can be claimed, for leased jobs the time at which the lease expires.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    available_at REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, available_at);
+"""
+
+
+def get_job_id(payload):
+    """
+    Return the id of a job, which is the same for identical jobs on every host, so they are only looked up once.
+
+    A job is a whole bibitem rather than a DOI or arXiv id, since its record also depends on the rest of the
+    bibitem: its identifier, the reformatted original reference, the split into several references, matches in
+    the reference index for references without a DOI or arXiv id, and the DOI of an arXiv preprint, which is only
+    known after it has been looked up. So a DOI in differently worded bibitems is looked up once for each of them.
+    """
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class JobQueue:
+    """
+    A queue of jobs in an SQLite database.
+
+    Every change to the queue is made while holding the write lock on the database, so a job is never
+    claimed by two workers at once. Lease times are taken from the wall clock, so the clocks of hosts
+    sharing a queue should be (roughly) synchronized. Each thread should use its own JobQueue.
+    """
+    def __init__(self, queue_file, lease_duration=LEASE_DURATION, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+        import sqlite3
+        self.queue_file = queue_file
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # Transactions are started explicitly. The default rollback journal is used, since
+        # write-ahead logging does not work for databases on a shared (network) filesystem.
+        self.connection = sqlite3.connect(queue_file, timeout=LOCK_TIMEOUT, isolation_level=None)
+        with self.transaction():
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        """Hold the write lock on the database for the duration of a transaction."""
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def enqueue(self, payloads):
+        """
+        Add jobs to the queue and return their ids.
+
+        Jobs which are already in the queue are not added again, but jobs which failed are retried.
+        """
+        job_ids = [get_job_id(payload) for payload in payloads]
+        with self.transaction():
+            self.connection.executemany("INSERT OR IGNORE INTO jobs (job_id, payload) VALUES (?, ?)",
+                                        [(job_id, json.dumps(payload)) for job_id, payload in zip(job_ids, payloads)])
+            self.connection.executemany("UPDATE jobs SET status = 'pending', attempts = 0, available_at = 0, result = NULL WHERE job_id = ? AND status = 'failed'",
+                                        [(job_id,) for job_id in set(job_ids)])
+        return job_ids
+
+    def claim(self, worker):
+        """Lease the oldest job that can be claimed, returning its id, payload and attempt number (or None)."""
+        now = time.time()
+        with self.transaction():
+            # Jobs whose workers crashed too often are given up on.
+            self.connection.execute("UPDATE jobs SET status = 'failed', error = 'The lease expired.' WHERE status = 'leased' AND available_at <= ? AND attempts >= ?",
+                                    (now, self.max_attempts))
+            job = self.connection.execute("SELECT job_id, payload, attempts FROM jobs WHERE status IN ('pending', 'leased') AND available_at <= ? ORDER BY rowid LIMIT 1",
+                                          (now,)).fetchone()
+            if job is None:
+                return None
+            job_id, payload, attempts = job
+            self.connection.execute("UPDATE jobs SET status = 'leased', worker = ?, available_at = ?, attempts = ? WHERE job_id = ?",
+                                    (worker, now + self.lease_duration, attempts + 1, job_id))
+        return job_id, json.loads(payload), attempts + 1
+
+    def complete(self, job_id, worker, result):
+        """Store the result of a job, returning False if the worker's lease was taken over by another worker."""
+        with self.transaction():
+            cursor = self.connection.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL WHERE job_id = ? AND worker = ? AND status = 'leased'",
+                                             (json.dumps(result, ensure_ascii=False), job_id, worker))
+        return cursor.rowcount == 1
+
+    def release(self, job_id, worker, error, result=None):
+        """
+        Give back a job after an error, so it is retried later, or mark it as failed after the last attempt.
+
+        The result of the failed attempt (if any) is stored, so it can be used if the job fails.
+        """
+        with self.transaction():
+            cursor = self.connection.execute("""UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                                                                worker = NULL, available_at = ?, error = ?, result = ?
+                                                WHERE job_id = ? AND worker = ? AND status = 'leased'""",
+                                             (self.max_attempts, time.time() + self.retry_delay, error,
+                                              json.dumps(result, ensure_ascii=False) if result is not None else None, job_id, worker))
+        return cursor.rowcount == 1
+
+    def results(self, job_ids):
+        """Return the status and result of jobs."""
+        job_ids = list(job_ids)
+        results = {}
+        for start in range(0, len(job_ids), QUERY_SIZE):
+            chunk = job_ids[start:start + QUERY_SIZE]
+            query = f"SELECT job_id, status, result FROM jobs WHERE job_id IN ({', '.join('?' * len(chunk))})"
+            for job_id, status, result in self.connection.execute(query, chunk):
+                results[job_id] = (status, json.loads(result) if result is not None else None)
+        return results
+
+    def counts(self):
+        """Return the number of jobs with every status."""
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def wait(self, job_ids, deadline=None, poll_interval=POLL_INTERVAL):
+        """
+        Yield the id, status and result of jobs as soon as they are done or have failed.
+
+        Stops when all jobs are finished, or when the deadline is reached.
+        """
+        unfinished = set(job_ids)
+        while True:
+            for job_id, (status, result) in self.results(unfinished).items():
+                if status in ("done", "failed"):
+                    unfinished.discard(job_id)
+                    yield job_id, status, result
+            if not unfinished or (deadline is not None and deadline.expired()):
+                return
+            time.sleep(poll_interval if deadline is None else min(poll_interval, deadline.remaining()))
+
+
+def lookup_queued_references(job_queue, bibtex_entries, add_arxiv=False, deadline=None, poll_interval=POLL_INTERVAL):
+    """
+    Have bibitems looked up by the workers of a job queue, yielding the position of every bibitem and the
+    record of its reference as soon as it has been looked up.
+
+    Bibitems whose jobs failed get the record of the last attempt to look them up, if there was one, or else the
+    record of a reference which was not looked up, with status queue_failed. Bibitems which were not looked up
+    before the deadline get such a record with status deadline_exceeded.
+    """
+    payloads = [{"bibitem": bibtex_entry.rstrip(), "add_arxiv": add_arxiv} for bibtex_entry in bibtex_entries]
+    numbers = {}
+    for number, job_id in enumerate(job_queue.enqueue(payloads)):
+        numbers.setdefault(job_id, []).append(number)
+    for job_id, status, result in job_queue.wait(numbers, deadline, poll_interval):
+        for number in numbers.pop(job_id):
+            yield number, result if result is not None else unresolved_record(payloads[number], "queue_failed")
+    for remaining_numbers in numbers.values():
+        for number in remaining_numbers:
+            yield number, unresolved_record(payloads[number], "deadline_exceeded")
+
+
+def unresolved_record(payload, status):
+    """Return the record of a reference which has not been looked up, with the status giving the reason."""
+    reference = Reference(payload["bibitem"], payload["add_arxiv"], deadline=Deadline(0))
+    reference.main()
+    record = reference.record()
+    record["status"] = status
+    return record
+
+
+def lookup_payload(payload, reference_index=None):
+    """Look up the reference of a job, returning its record."""
+    reference = Reference(payload["bibitem"], payload["add_arxiv"], reference_index=reference_index)
+    reference.main()
+    if reference_index is not None:
+        reference_index.add_reference(reference)
+    return reference.record()
+
+
+def work(queue_file, worker, reference_index=None, exit_when_empty=False, poll_interval=POLL_INTERVAL):
+    """
+    Claim and look up jobs one at a time, returning the number of completed jobs.
+
+    With exit_when_empty, the worker stops when no jobs are pending or leased, otherwise it keeps waiting for new jobs.
+    """
+    job_queue = JobQueue(queue_file)
+    completed = 0
+    try:
+        while True:
+            job = job_queue.claim(worker)
+            if job is None:
+                counts = job_queue.counts()
+                if exit_when_empty and not counts.get("pending") and not counts.get("leased"):
+                    return completed
+                time.sleep(poll_interval)
+                continue
+            job_id, payload, _ = job
+            try:
+                record = lookup_payload(payload, reference_index)
+            except Exception as error:
+                job_queue.release(job_id, worker, repr(error))
+                continue
+            if record["status"] in RETRY_STATUSES and record["transient_error"]:
+                # After the last attempt, the job fails, so it is retried when it is added to the queue again.
+                job_queue.release(job_id, worker, f"The lookup {record['status'].replace('_', ' ')}.", record)
+            elif job_queue.complete(job_id, worker, record):
+                completed += 1
+    finally:
+        job_queue.close()
+
+
+def run_workers(queue_file, threads=1, reference_index=None, exit_when_empty=False):
+    """Run workers in several threads, which share the concurrency limits for every upstream host."""
+    worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+    completed = []
+
+    def run_worker(number):
+        completed.append(work(queue_file, f"{worker_prefix}:{number}", reference_index, exit_when_empty))
+
+    workers = [threading.Thread(target=run_worker, args=(number,)) for number in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(completed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Look up the references in a job queue, which are added by the reference formatter or scraper with --queue.")
+    parser.add_argument('queue_file')
+    parser.add_argument('--threads', type=int, default=16, help="Number of references looked up at the same time (default: 16).")
+    parser.add_argument('--index', help="Index file of previously looked up references, used to find references without a DOI or arXiv id. Newly looked up references are added to it.")
+    parser.add_argument('--exit_when_empty', action="store_true", help="Stop when there are no more jobs, instead of waiting for new ones.")
+    parser.add_argument('--status', action="store_true", help="Only show the number of jobs with every status.")
+    args = parser.parse_args()
+    if args.status:
+        job_queue = JobQueue(args.queue_file)
+        print(", ".join(f"{count} {status}" for status, count in sorted(job_queue.counts().items())) or "The queue is empty.")
+        job_queue.close()
+    else:
+        reference_index = ReferenceIndex(args.index) if args.index else None
+        try:
+            completed = run_workers(args.queue_file, args.threads, reference_index, args.exit_when_empty)
+            print(f"Looked up {completed} references.")
+        finally:
+            if reference_index is not None:
+                reference_index.close()
@@ -1,9 +1,14 @@
 """ Utilities to work with LaTeX files. """
 
+import codecs
+import mmap
+import os
 import re
-import requests
 import unicodedata
 import sys
+import time
+
+from concurrency import CONTROLLER, REQUEST_TIMEOUT, hedged_call, request_slot
 
 
 def read_latex_file(latex_file):
@@ -21,6 +26,103 @@ def write_latex_file(latex_file, latex_source):
         open_file.write(latex_source)
 
 
+BIBLIOGRAPHY_BEGIN = b"\\begin{thebibliography}"
+BIBLIOGRAPHY_END = b"\\end{thebibliography}"
+# Size (in bytes) of the blocks in which the rest of a LaTeX file is copied when splicing in new bibliographies.
+COPY_BLOCK_SIZE = 1 << 20
+
+
+def detect_encoding(data):
+    """Return the encoding in which read_latex_file decodes (memory-mapped) file contents, decoding them block by block."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        for start in range(0, len(data), COPY_BLOCK_SIZE):
+            decoder.decode(data[start:start + COPY_BLOCK_SIZE])
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return "latin-1"
+    return "utf-8"
+
+
+def read_bibliography_regions(latex_file):
+    """
+    Read only the thebibliography environments of a LaTeX file, without loading the rest of the file into memory.
+
+    The file is memory-mapped and searched for the environments, and only these are decoded, in the encoding
+    of the whole file (as chosen by read_latex_file). Returns the start and end (byte) offset, text and encoding
+    of every environment, in order of appearance. An environment which is not closed runs until the end of the file.
+    """
+    regions = []
+    with open(latex_file, "rb") as data:
+        if os.fstat(data.fileno()).st_size == 0:
+            return regions
+        with mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            encoding = detect_encoding(mapped)
+            position = 0
+            while True:
+                start = mapped.find(BIBLIOGRAPHY_BEGIN, position)
+                if start == -1:
+                    break
+                end = mapped.find(BIBLIOGRAPHY_END, start)
+                end = len(mapped) if end == -1 else end + len(BIBLIOGRAPHY_END)
+                regions.append((start, end, mapped[start:end].decode(encoding), encoding))
+                position = end
+    return regions
+
+
+def splice_latex_file(latex_file, regions):
+    """
+    Replace regions (as returned by read_bibliography_regions, with new text) of a LaTeX file.
+
+    The rest of the file is copied block by block into a temporary file next to it, which then replaces the file,
+    so the file is never held in memory and is left untouched if anything goes wrong. Every region is encoded in
+    the encoding it was read with; characters which cannot be encoded in latin-1 are replaced by question marks.
+    """
+    import tempfile
+    directory = os.path.dirname(os.path.abspath(latex_file))
+    with open(latex_file, "rb") as data, tempfile.NamedTemporaryFile("wb", dir=directory, delete=False) as spliced:
+        try:
+            position = 0
+            for start, end, text, encoding in sorted(regions):
+                while position < start:
+                    block = data.read(min(COPY_BLOCK_SIZE, start - position))
+                    if not block:
+                        raise ValueError(f"{latex_file} changed since its bibliography regions were read.")
+                    spliced.write(block)
+                    position += len(block)
+                spliced.write(text.encode(encoding, errors="replace"))
+                data.seek(end)
+                position = end
+            for block in iter(lambda: data.read(COPY_BLOCK_SIZE), b""):
+                spliced.write(block)
+        except BaseException:
+            spliced.close()
+            os.remove(spliced.name)
+            raise
+    os.chmod(spliced.name, os.stat(latex_file).st_mode)
+    os.replace(spliced.name, latex_file)
+
+
+def next_occurrence_finder(text):
+    """
+    Return a function which gives the position of the next occurrence of a substring in text at or after a position.
+
+    The function returns len(text) if there is no such occurrence. The last occurrence of every substring is
+    remembered, so as long as the positions asked for do not decrease, finding all occurrences of a substring
+    takes time linear in the length of the text, however often it is asked for.
+    """
+    occurrences = {}
+
+    def find(substring, position):
+        occurrence, searched_from = occurrences.get(substring, (None, None))
+        if occurrence is None or not searched_from <= position <= occurrence:
+            occurrence = text.find(substring, position)
+            occurrence = len(text) if occurrence == -1 else occurrence
+            occurrences[substring] = (occurrence, position)
+        return occurrence
+    return find
+
+
 def get_relevant_warnings(log_file):
     """Extract relevant warnings from a LaTeX log file."""
     overfull_lines = re.findall(r"Overfull \\hbox .*", log_file)
@@ -33,12 +135,59 @@ def remove_accented_characters(string):
     return unicodedata.normalize('NFD', string).encode('ascii', 'ignore').decode('utf-8')
 
 
-def open_webpage(address, exit_on_error=True):
-    """Return succes/failure and the request server response for a webpage."""
+def get_webpage(address, timeout=REQUEST_TIMEOUT, end=None, cancelled=None):
+    """
+    Request a webpage, raising an exception on failure.
+
+    The response has to arrive before end (a time.monotonic() time, by default timeout seconds from now).
+    The time spent waiting for a request slot counts towards this, so the request itself gets what is left.
+    If the cancelled event (of a hedged call) is set when a slot becomes available, no request is sent and None is returned.
+    """
+    # Imported here, since requests is slow to import and not needed for fully local runs.
+    import requests
+    end = time.monotonic() + timeout if end is None else end
+    with request_slot(address, timeout=max(0, end - time.monotonic())) as outcome:
+        if cancelled is not None and cancelled.is_set():
+            outcome.not_sent()
+            return None
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            outcome.not_sent()
+            raise requests.exceptions.Timeout(f"No time left to open {address}")
+        try:
+            server_response = requests.get(address, timeout=remaining)
+            server_response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            outcome.failed(getattr(e.response, "status_code", None))
+            raise
+    return server_response
+
+
+def is_transient_error(error):
+    """Return whether a request which failed with an error (as returned by open_webpage) may succeed when it is tried again."""
+    # Timeouts and connection errors have no response. Of the HTTP errors, only throttling and server errors are transient.
+    status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+def open_webpage(address, exit_on_error=True, timeout=REQUEST_TIMEOUT, hedge=False):
+    """
+    Return succes/failure and the request server response for a webpage.
+
+    With hedge, a duplicate request is sent if the response takes longer than is usual for the host.
+    """
+    import requests
     try:
-        server_response = requests.get(address, timeout=20)
-        server_response.raise_for_status()
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
+        if timeout <= 0:
+            raise requests.exceptions.Timeout(f"No time left to open {address}")
+        # The duplicate of a hedged request only gets the time that is left.
+        end = time.monotonic() + timeout
+        if hedge:
+            hedge_delay = CONTROLLER.limiter(address).hedge_delay()
+            server_response = hedged_call(lambda cancelled: get_webpage(address, end=end, cancelled=cancelled), hedge_delay)
+        else:
+            server_response = get_webpage(address, end=end)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.HTTPError, TimeoutError) as e:
         if exit_on_error:
             sys.exit(e)
         else:
@@ -1,42 +1,145 @@
 """Automatically format references in a LaTeX file."""
 
 import argparse
-from multiprocessing import Pool
+import os
+import sys
 
-from reference_utils import Reference, extract_bibtex_items
-from latex_utils import read_latex_file, write_latex_file
+from reference_utils import Reference, extract_bibtex_items, extract_bibtex_item_spans, write_reference_records, write_records
+from latex_utils import read_latex_file, write_latex_file, read_bibliography_regions, splice_latex_file
+from concurrency import CONTROLLER, Deadline, adaptive_map
+from bibtex_utils import read_cited_bibitems
+from reference_index import ReferenceIndex
+from job_queue import JobQueue, lookup_queued_references
+
+# Comment added to bibitems which could not be looked up, followed by the reason (for the status giving it).
+UNRESOLVED_MARKER = "%UNRESOLVED:"
+UNRESOLVED_MESSAGES = {"deadline_exceeded": "the deadline was reached before this reference could be looked up.",
+                       "queue_failed": "the workers of the job queue failed to look up this reference."}
+
+
+def remove_unresolved_markers(bibtex_entry):
+    """Remove the comments added to a bibitem which could not be looked up in an earlier run."""
+    return "".join(line for line in bibtex_entry.splitlines(keepends=True) if not line.lstrip().startswith(UNRESOLVED_MARKER))
 
 
 class ReferenceFormatter:
-    def __init__(self, add_arxiv):
+    def __init__(self, add_arxiv, deadline=None, reference_index=None, job_queue=None):
         self.add_arxiv = add_arxiv
+        self.deadline = deadline
+        self.reference_index = reference_index
+        self.job_queue = job_queue
+
+    def lookup_reference(self, bibtex_entry):
+        """Look up a single bibitem."""
+        reference = Reference(remove_unresolved_markers(bibtex_entry).rstrip(), self.add_arxiv, self.deadline, self.reference_index)
+        reference.main()
+        if self.reference_index is not None:
+            self.reference_index.add_reference(reference)
+        return reference
 
     def get_reference(self, bibtex_entry):
         """Wrapper for multithreading."""
-        reference = Reference(bibtex_entry.rstrip(), self.add_arxiv)
-        reference.main()
-        return reference.bibitem_data, reference.bibitem_identifier, reference.reformatted_original_reference, reference.formatted_reference
+        reference = self.lookup_reference(bibtex_entry)
+        # The bibitem as it is in the LaTeX source, so it can be replaced.
+        return bibtex_entry.rstrip(), reference.bibitem_identifier, reference.reformatted_original_reference, reference.formatted_reference, "deadline_exceeded" if reference.timed_out() else None
+
+    def get_references(self, bibtex_entries):
+        """Look up bibitems in this process, or have them looked up by the workers of the job queue (if there is one)."""
+        if self.job_queue is None:
+            return adaptive_map(self.get_reference, bibtex_entries)
+        results = [None] * len(bibtex_entries)
+        queued_entries = [remove_unresolved_markers(bibtex_entry) for bibtex_entry in bibtex_entries]
+        for number, record in lookup_queued_references(self.job_queue, queued_entries, self.add_arxiv, self.deadline):
+            results[number] = (bibtex_entries[number].rstrip(), record["bibitem_identifier"], record["reformatted_original_reference"],
+                               record["formatted_reference"], record["status"] if record["status"] in UNRESOLVED_MESSAGES else None)
+        return results
+
+    def format_bibitem(self, result):
+        """Return the text which replaces a bibitem after it has been looked up."""
+        bibitem_data, bibitem_identifier, reformatted_original_reference, formatted_reference, unresolved_status = result
+        if unresolved_status:
+            # Keep the original reference, so it can be formatted in a later run.
+            return f"{remove_unresolved_markers(bibitem_data).rstrip()}\n{UNRESOLVED_MARKER} {UNRESOLVED_MESSAGES[unresolved_status]}"
+        return f"\\bibitem{{{bibitem_identifier}}} \\textcolor{{red}}{{TODO}}\n{reformatted_original_reference}\n\n%{formatted_reference}\n\n\n"
 
     def format_references(self, latex_source):
         """Format all references in the given LaTeX source."""
         bibtex_entries = extract_bibtex_items(latex_source)
-        # Parallelising the reference lookup gives a 15x speedup.
-        # Values larger than 15 for the poolsize do not give a further speedup.
-        with Pool(15) as pool:
-            res = pool.map(self.get_reference, bibtex_entries)
+        # The reference lookups are overlapped, with the number of concurrent requests adapted to each upstream host.
+        res = self.get_references(bibtex_entries)
         for r in res:
-            bibitem_data, bibitem_identifier, reformatted_original_reference, formatted_reference = r
-            latex_source = latex_source.replace(bibitem_data, f"\\bibitem{{{bibitem_identifier}}} \\textcolor{{red}}{{TODO}}\n{reformatted_original_reference}\n\n%{formatted_reference}\n\n\n")
+            latex_source = latex_source.replace(r[0], self.format_bibitem(r))
         return latex_source
 
+    def format_bibliography_regions(self, latex_file, regions):
+        """Format the references in the given thebibliography environments of a LaTeX file, rewriting only those."""
+        splice_latex_file(latex_file, [(start, end, self.format_references(text), encoding) for start, end, text, encoding in regions])
+
+    def format_bibliography(self, bibtex_entries):
+        """Format the given bibitems (e.g. read from a .bib file) into a new thebibliography environment."""
+        res = self.get_references(bibtex_entries)
+        formatted_bibitems = "\n\n".join(self.format_bibitem(r).rstrip("\n") for r in res)
+        return f"\\begin{{thebibliography}}{{99}}\n\n{formatted_bibitems}\n\n\\end{{thebibliography}}\n"
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('latex_file')
     parser.add_argument('--add_arxiv', action="store_true")
+    parser.add_argument('--bib', help="Format the references cited in the LaTeX file from this .bib or .bbl file, instead of the bibitems in the LaTeX file.")
+    parser.add_argument('--index', help="Index file of previously looked up references, used to find references without a DOI or arXiv id. Newly looked up references are added to it.")
+    parser.add_argument('--deadline', type=float, help="Maximum time (in seconds) to spend looking up references. References which were not looked up in time are left as is.")
+    parser.add_argument('--output', choices=["latex", "jsonl"], default="latex",
+                        help="Rewrite the references in the LaTeX file (default), or write a JSON record for every bibitem as soon as it has been looked up.")
+    parser.add_argument('--output_file', help="File to write the JSON records to (default: standard output).")
+    parser.add_argument('--stats', action="store_true", help="Show the concurrency limits used for every upstream host.")
+    parser.add_argument('--mmap', action="store_true",
+                        help="Only read and rewrite the thebibliography environments of the LaTeX file, for very large files.")
+    parser.add_argument('--queue', help="Job queue file from which the references are looked up by workers (started with job_queue.py), instead of by this process.")
     args = parser.parse_args()
-    latex_source = read_latex_file(args.latex_file)
-    print("Processing references...")
-    reference_formatter = ReferenceFormatter(args.add_arxiv)
-    latex_source = reference_formatter.format_references(latex_source)
-    write_latex_file(args.latex_file, latex_source)
+    if args.mmap and args.bib:
+        parser.error("--mmap cannot be used with --bib, which needs the citations in the whole LaTeX file.")
+    if args.queue and args.index:
+        parser.error("With --queue, the index file is used by the workers, so give --index to job_queue.py instead.")
+    deadline = Deadline(args.deadline) if args.deadline is not None else None
+    # Keep standard output clean for the JSON records.
+    log = sys.stderr if args.output == "jsonl" else sys.stdout
+    if args.mmap:
+        regions = read_bibliography_regions(args.latex_file)
+        latex_source = "".join(text for _, _, text, _ in regions)
+    else:
+        latex_source = read_latex_file(args.latex_file)
+    print("Processing references...", file=log)
+    reference_index = ReferenceIndex(args.index) if args.index else None
+    job_queue = JobQueue(args.queue) if args.queue else None
+    reference_formatter = ReferenceFormatter(args.add_arxiv, deadline, reference_index, job_queue)
+    if args.bib:
+        bibtex_entries, missing_keys = read_cited_bibitems(args.bib, latex_source)
+        spans = None
+        if missing_keys:
+            print(f"The following references are cited, but not found in {args.bib}: {', '.join(missing_keys)}", file=log)
+    else:
+        bibtex_entries = extract_bibtex_items(latex_source)
+        # With --mmap, positions in the bibliographies are not positions in the LaTeX file.
+        spans = None if args.mmap else extract_bibtex_item_spans(latex_source)
+    if args.output == "jsonl":
+        output = open(args.output_file, "w", encoding="utf-8") if args.output_file else sys.stdout
+        if job_queue is not None:
+            write_records(lookup_queued_references(job_queue, bibtex_entries, args.add_arxiv, deadline), output, spans)
+        else:
+            write_reference_records(reference_formatter.lookup_reference, bibtex_entries, output, spans)
+        if args.output_file:
+            output.close()
+    elif args.bib:
+        bibliography_file = f"{os.path.splitext(args.latex_file)[0]}_bibliography.tex"
+        write_latex_file(bibliography_file, reference_formatter.format_bibliography(bibtex_entries))
+        print(f"The formatted bibliography was written to {bibliography_file}.")
+    elif args.mmap:
+        reference_formatter.format_bibliography_regions(args.latex_file, regions)
+    else:
+        latex_source = reference_formatter.format_references(latex_source)
+        write_latex_file(args.latex_file, latex_source)
+    if reference_index is not None:
+        reference_index.close()
+    if args.stats:
+        print(CONTROLLER.report(), file=log)
@@ -0,0 +1,228 @@
+"""A local index of previously looked up references, to find references which have no DOI or arXiv id."""
+
+import json
+import math
+import re
+import threading
+from contextlib import contextmanager
+
+from latex_utils import remove_accented_characters
+
+# Words which are too common to tell references apart.
+STOPWORDS = {"a", "al", "an", "and", "as", "at", "by", "et", "for", "from", "in", "of", "on", "the", "to", "with"}
+# Fields of a record which are added to the index.
+INDEXED_FIELDS = ["title", "first_author", "journal", "short_journal", "volume", "page", "year"]
+# Number of the rarest tokens of a reference which are used to find candidate records,
+# and how many of those a candidate record must contain.
+CANDIDATE_TOKENS = 4
+CANDIDATE_HITS = 2
+# Tokens which occur in more records than this are not used to find candidate records.
+MAX_POSTINGS = 5000
+# Minimal number of tokens that a reference and a record must have in common to be matched.
+MIN_MATCHED_TOKENS = 3
+# Minimal confidence for an indexed record to be used for a reference.
+MATCH_THRESHOLD = 0.7
+# Time (in seconds) to wait for another process to release its lock on the index file.
+LOCK_TIMEOUT = 60
+# Maximum number of tokens or records in a single query.
+QUERY_SIZE = 500
+# Fields of a record which have to appear in a reference containing numbers, for the record to match it.
+NUMBER_FIELDS = ["volume", "page", "year"]
+
+# The records (with their tokens), the records containing every token, and the number of those records.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    record_id INTEGER PRIMARY KEY,
+    identifier TEXT NOT NULL UNIQUE,
+    record TEXT NOT NULL,
+    tokens TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    token TEXT NOT NULL,
+    record_id INTEGER NOT NULL,
+    PRIMARY KEY (token, record_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS token_counts (
+    token TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def tokenize(text):
+    """Split text into lower case words and numbers, without LaTeX commands, accents and stopwords."""
+    text = re.sub(r"\\[a-zA-Z]+", " ", text)
+    text = remove_accented_characters(text).lower()
+    return [token for token in re.split(r"[^a-z0-9]+", text)
+            if token not in STOPWORDS and (len(token) > 1 or token.isdigit())]
+
+
+def record_from_reference(reference):
+    """Return an index record for a reference that has been looked up, or None if the lookup failed."""
+    if not (reference.crossref_data or reference.arxiv_data) or not (reference.doi or reference.arxiv_id):
+        return None
+    # Imported here to prevent a circular import.
+    from reference_utils import get_first_author_last_name
+    return {"doi": reference.doi if reference.crossref_data else None,
+            "arxiv_id": reference.arxiv_id,
+            "title": reference.title,
+            "first_author": get_first_author_last_name(reference.full_authors) if reference.full_authors else None,
+            "journal": reference.journal,
+            "short_journal": reference.short_journal,
+            "volume": reference.volume,
+            "page": reference.page or reference.article_number,
+            "year": reference.year}
+
+
+def token_weight(count, size):
+    """Return the inverse document frequency of a token in count of size records, which is largest for tokens that are not in the index."""
+    return math.log((size + 1) / max(1, count))
+
+
+def numbers_match(record, tokens):
+    """
+    Return whether the volume, (first) page and year of a record appear in the tokens of a reference, if it contains numbers.
+
+    A reference with other numbers than the year and those in the title (e.g. a volume and page) only matches a
+    record with a volume or page, so a preprint does not match a different, published work by the same author.
+    """
+    numbers = {token for token in tokens if token.isdigit()}
+    if not numbers:
+        return True
+    explained = set(tokenize(record["title"])) if record.get("title") else set()
+    for field in NUMBER_FIELDS:
+        if record.get(field):
+            first_token = tokenize(str(record[field]))[:1]
+            if first_token and first_token[0] not in tokens:
+                return False
+            explained.update(first_token)
+    return bool(record.get("volume") or record.get("page")) or numbers <= explained
+
+
+class ReferenceIndex:
+    """
+    An inverted index from words and numbers to records of looked up references, stored in an SQLite database.
+
+    References are matched by the weight (inverse document frequency) of the tokens they have in
+    common with a record, relative to the weights of the tokens of both (the Dice coefficient), so
+    neither a short record nor a short reference matches everything containing its tokens.
+    Only records sharing some of the rarest tokens of the reference are scored, so the time
+    needed for a lookup hardly depends on the size of the index. Opening an index file takes
+    no time either, since nothing is loaded until a reference is looked up.
+    """
+    def __init__(self, index_file=None):
+        import sqlite3
+        self.index_file = index_file
+        self.lock = threading.Lock()
+        # As for the job queue, transactions are started explicitly and the default rollback journal is
+        # used, so workers on several hosts can share an index file. Without a file, the index is kept in memory.
+        self.connection = sqlite3.connect(index_file or ":memory:", timeout=LOCK_TIMEOUT, isolation_level=None, check_same_thread=False)
+        with self.transaction():
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.size()
+
+    @contextmanager
+    def transaction(self):
+        """Hold the write lock on the database for the duration of a transaction."""
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def query(self, query, parameters):
+        """Yield the rows of a query with an IN ({}) clause, which is run for chunks of the parameters."""
+        parameters = list(parameters)
+        for start in range(0, len(parameters), QUERY_SIZE):
+            chunk = parameters[start:start + QUERY_SIZE]
+            yield from self.connection.execute(query.format(", ".join("?" * len(chunk))), chunk)
+
+    def size(self):
+        """Return the number of records (the caller holds the lock)."""
+        # Records are never removed, so this is the number of records, without counting them.
+        return self.connection.execute("SELECT MAX(record_id) FROM records").fetchone()[0] or 0
+
+    def token_counts(self, tokens):
+        """Return the number of records containing each of the tokens which are in the index (the caller holds the lock)."""
+        return dict(self.query("SELECT token, count FROM token_counts WHERE token IN ({})", tokens))
+
+    def add(self, record):
+        """Add a record to the index, returning False if a record with the same DOI or arXiv id is already present."""
+        return self.add_records([record]) == 1
+
+    def add_records(self, records):
+        """Add records to the index in a single transaction, returning the number of records which were not yet present."""
+        added = 0
+        counts = {}
+        with self.lock, self.transaction():
+            for record in records:
+                tokens = set()
+                for field in INDEXED_FIELDS:
+                    if record.get(field):
+                        tokens.update(tokenize(str(record[field])))
+                cursor = self.connection.execute("INSERT OR IGNORE INTO records (identifier, record, tokens) VALUES (?, ?, ?)",
+                                                 (record["doi"] or record["arxiv_id"], json.dumps(record, ensure_ascii=False), " ".join(tokens)))
+                if cursor.rowcount == 0:
+                    continue
+                added += 1
+                self.connection.executemany("INSERT INTO postings (token, record_id) VALUES (?, ?)",
+                                            [(token, cursor.lastrowid) for token in tokens])
+                for token in tokens:
+                    counts[token] = counts.get(token, 0) + 1
+            self.connection.executemany("INSERT OR IGNORE INTO token_counts (token, count) VALUES (?, 0)", [(token,) for token in counts])
+            self.connection.executemany("UPDATE token_counts SET count = count + ? WHERE token = ?",
+                                        [(count, token) for token, count in counts.items()])
+        return added
+
+    def add_reference(self, reference):
+        """Add a reference that has been looked up (or all references in a bibitem with multiple references) to the index."""
+        records = [record_from_reference(reference) for reference in reference.sub_references or [reference]]
+        if any(records):
+            self.add_records([record for record in records if record])
+
+    def search(self, text):
+        """Return the best matching record for a free text reference and the confidence (between 0 and 1) of the match."""
+        reference_tokens = set(tokenize(text))
+        with self.lock:
+            size = self.size()
+            counts = self.token_counts(reference_tokens)
+            rare_tokens = sorted((token for token in counts if counts[token] <= MAX_POSTINGS), key=counts.get)[:CANDIDATE_TOKENS]
+            hits = {}
+            for record_id, in self.query("SELECT record_id FROM postings WHERE token IN ({})", rare_tokens):
+                hits[record_id] = hits.get(record_id, 0) + 1
+            required_hits = min(CANDIDATE_HITS, len(rare_tokens))
+            candidates = [(json.loads(record), tokens.split())
+                          for record, tokens in self.query("SELECT record, tokens FROM records WHERE record_id IN ({})",
+                                                           [record_id for record_id, candidate_hits in hits.items() if candidate_hits >= required_hits])]
+            counts.update(self.token_counts({token for _, tokens in candidates for token in tokens} - reference_tokens))
+        weights = {token: token_weight(counts.get(token, 0), size) for token in reference_tokens}
+        reference_weight = sum(weights.values())
+        best_record, best_confidence = None, 0
+        for record, record_tokens in candidates:
+            if not numbers_match(record, reference_tokens):
+                continue
+            matched_weight = record_weight = 0
+            matched_tokens = 0
+            for token in record_tokens:
+                if token not in weights:
+                    weights[token] = token_weight(counts[token], size)
+                record_weight += weights[token]
+                if token in reference_tokens:
+                    matched_weight += weights[token]
+                    matched_tokens += 1
+            if matched_tokens < MIN_MATCHED_TOKENS or record_weight == 0:
+                continue
+            confidence = 2 * matched_weight / (record_weight + reference_weight)
+            if confidence > best_confidence:
+                best_record, best_confidence = record, confidence
+        return best_record, best_confidence
@@ -2,11 +2,16 @@
 
 import argparse
 import re
-import webbrowser
-from multiprocessing import Pool
+import sys
+from functools import partial
+from itertools import chain
 
-from reference_utils import Reference, extract_bibtex_items, abbreviate_authors
-from latex_utils import read_latex_file, remove_accented_characters
+from reference_utils import Reference, extract_bibtex_items, extract_bibtex_item_spans, abbreviate_authors, split_bibitem, write_reference_records, write_records
+from latex_utils import read_latex_file, read_bibliography_regions, remove_accented_characters
+from concurrency import CONTROLLER, Deadline, adaptive_map
+from bibtex_utils import read_cited_bibitems
+from reference_index import ReferenceIndex
+from job_queue import JobQueue, lookup_queued_references
 
 
 def get_unique_names(names):
@@ -23,27 +28,57 @@ def get_unique_names(names):
     return unique_names
 
 
-def get_reference(bibtex_entry):
-    """Wrapper function for parallelization."""
-    reference = Reference(bibtex_entry.rstrip())
+def lookup_reference(bibtex_entry, deadline=None, reference_index=None):
+    """Look up a single bibitem."""
+    reference = Reference(bibtex_entry.rstrip(), deadline=deadline, reference_index=reference_index)
     reference.main()
-    return reference.year, reference.full_authors, reference.bibitem_data
+    if reference_index is not None:
+        reference_index.add_reference(reference)
+    return reference
+
+
+def get_reference(bibtex_entry, deadline=None, reference_index=None):
+    """Wrapper function for parallelization."""
+    reference = lookup_reference(bibtex_entry, deadline, reference_index)
+    # A bibitem can contain multiple references, which are checked individually.
+    return [(r.year, r.full_authors, r.bibitem_data) for r in reference.sub_references or [reference]]
+
+
+def get_queued_references(job_queue, bibtex_entries, deadline=None):
+    """Have bibitems looked up by the workers of a job queue, returning the same as get_reference for every bibitem."""
+    results = [None] * len(bibtex_entries)
+    for number, record in lookup_queued_references(job_queue, bibtex_entries, deadline=deadline):
+        bibitem_data = bibtex_entries[number].rstrip()
+        if record.get("sub_references"):
+            # The workers split the bibitem in the same way.
+            results[number] = [(sub_record["year"], sub_record["full_authors"], sub_bibitem_data)
+                               for sub_record, sub_bibitem_data in zip(record["sub_references"], split_bibitem(bibitem_data))]
+        else:
+            results[number] = [(record["year"], record["full_authors"], bibitem_data)]
+    return results
 
 
 class ReferenceScraper:
-    def __init__(self, tex_source, debug=False):
+    def __init__(self, tex_source, debug=False, stats=False, deadline=None, bibtex_entries=None, reference_index=None, job_queue=None):
         self.tex_source = tex_source
+        self.reference_index = reference_index
+        self.job_queue = job_queue
+        self.bibtex_entries = bibtex_entries
         self.names = []
         self.unique_names = None
         self.check_manually = []
         self.debug = debug
+        self.stats = stats
+        self.deadline = deadline
 
     def main(self):
         print("Processing references...")
-        bibtex_entries = extract_bibtex_items(self.tex_source)
-        with Pool(15) as pool:
-            results = pool.map(get_reference, bibtex_entries)
-        for year, authors, bibentry in results:
+        bibtex_entries = self.bibtex_entries if self.bibtex_entries is not None else extract_bibtex_items(self.tex_source)
+        if self.job_queue is not None:
+            results = get_queued_references(self.job_queue, bibtex_entries, self.deadline)
+        else:
+            results = adaptive_map(partial(get_reference, deadline=self.deadline, reference_index=self.reference_index), bibtex_entries)
+        for year, authors, bibentry in chain.from_iterable(results):
             if year and int(year) >= 2000 and authors and len(authors) < 15:
                 for a in authors:
                     self.names.append(a)
@@ -51,6 +86,8 @@ class ReferenceScraper:
                 pass
             else:
                 self.check_manually.append(bibentry)
+        if self.stats:
+            print(CONTROLLER.report())
         self.unique_names = get_unique_names(self.names)
         print(f"The timely references were written by {len(self.names)} authors, of which {len(self.unique_names)} are unique.")
         if not self.debug:
@@ -66,6 +103,7 @@ class ReferenceScraper:
         return self.unique_names, self.check_manually
 
     def open_google_pages(self):
+        import webbrowser
         print("Opening Google search pages (in batches of 10):")
         for i, name in enumerate(sorted(list(self.unique_names), key=lambda x: x.split(' ')[-1])):
             webbrowser.open(f"https://www.google.com/search?q={name.replace(' ', '+')}+physics")
@@ -77,7 +115,52 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('latex_file')
     parser.add_argument("--debug", action="store_true")
+    parser.add_argument("--bib", help="Use the references cited in the LaTeX file from this .bib or .bbl file, instead of the bibitems in the LaTeX file.")
+    parser.add_argument("--index", help="Index file of previously looked up references, used to find references without a DOI or arXiv id. Newly looked up references are added to it.")
+    parser.add_argument("--deadline", type=float, help="Maximum time (in seconds) to spend looking up references. References which were not looked up in time have to be checked manually.")
+    parser.add_argument("--output", choices=["names", "jsonl"], default="names",
+                        help="Open search pages for the authors (default), or write a JSON record for every bibitem as soon as it has been looked up.")
+    parser.add_argument("--output_file", help="File to write the JSON records to (default: standard output).")
+    parser.add_argument("--stats", action="store_true", help="Show the concurrency limits used for every upstream host.")
+    parser.add_argument("--mmap", action="store_true", help="Only read the thebibliography environments of the LaTeX file, for very large files.")
+    parser.add_argument("--queue", help="Job queue file from which the references are looked up by workers (started with job_queue.py), instead of by this process.")
     args = parser.parse_args()
-    latex_source = read_latex_file(args.latex_file)
-    reference_scraper = ReferenceScraper(latex_source, debug=args.debug)
-    reference_scraper.main()
+    if args.mmap and args.bib:
+        parser.error("--mmap cannot be used with --bib, which needs the citations in the whole LaTeX file.")
+    if args.queue and args.index:
+        parser.error("With --queue, the index file is used by the workers, so give --index to job_queue.py instead.")
+    deadline = Deadline(args.deadline) if args.deadline is not None else None
+    # Keep standard output clean for the JSON records.
+    log = sys.stderr if args.output == "jsonl" else sys.stdout
+    if args.mmap:
+        latex_source = "".join(text for _, _, text, _ in read_bibliography_regions(args.latex_file))
+    else:
+        latex_source = read_latex_file(args.latex_file)
+    reference_index = ReferenceIndex(args.index) if args.index else None
+    job_queue = JobQueue(args.queue) if args.queue else None
+    bibtex_entries = None
+    if args.bib:
+        bibtex_entries, missing_keys = read_cited_bibitems(args.bib, latex_source)
+        if missing_keys:
+            print(f"The following references are cited, but not found in {args.bib}: {', '.join(missing_keys)}", file=log)
+    if args.output == "jsonl":
+        spans = None
+        if bibtex_entries is None:
+            bibtex_entries = extract_bibtex_items(latex_source)
+            # With --mmap, positions in the bibliographies are not positions in the LaTeX file.
+            spans = None if args.mmap else extract_bibtex_item_spans(latex_source)
+        output = open(args.output_file, "w", encoding="utf-8") if args.output_file else sys.stdout
+        if job_queue is not None:
+            write_records(lookup_queued_references(job_queue, bibtex_entries, deadline=deadline), output, spans)
+        else:
+            write_reference_records(partial(lookup_reference, deadline=deadline, reference_index=reference_index), bibtex_entries, output, spans)
+        if args.output_file:
+            output.close()
+        if args.stats:
+            print(CONTROLLER.report(), file=log)
+    else:
+        reference_scraper = ReferenceScraper(latex_source, debug=args.debug, stats=args.stats, deadline=deadline, bibtex_entries=bibtex_entries,
+                                             reference_index=reference_index, job_queue=job_queue)
+        reference_scraper.main()
+    if reference_index is not None:
+        reference_index.close()
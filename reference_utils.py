@@ -1,9 +1,11 @@
+import json
 import re
-
-from bs4 import BeautifulSoup
+import time
 
 from journal_abbreviations import JOURNAL_ABBRVS
-from latex_utils import open_webpage
+from latex_utils import is_transient_error, next_occurrence_finder, open_webpage
+from concurrency import adaptive_map, adaptive_imap_unordered
+from reference_index import MATCH_THRESHOLD
 
 
 def abbreviate_authors(list_of_authors):
@@ -42,54 +44,174 @@ def get_first_author_last_name(list_of_authors):
     return last_name.strip()
 
 
+BIBITEM_COMMAND = "\\bibitem"
+END_OF_BIBLIOGRAPHY = "\\end{thebibliography}"
+
+
+def extract_bibtex_item_spans(latex_source):
+    """
+    Return the start and end position in the LaTeX source of all bibtex items which are not commented out.
+
+    A bibtex item runs from \\bibitem{identifier} until the next bibtex item, the end of the bibliography
+    or the end of the source. The source is scanned once, so even for malformed sources (e.g. without
+    \\end{thebibliography}) the time taken is linear in its length.
+    """
+    find = next_occurrence_finder(latex_source)
+    length = len(latex_source)
+    start_of_item = BIBITEM_COMMAND + "{"
+    spans = []
+    position = 0
+    while True:
+        start = find(start_of_item, position)
+        if start == length:
+            break
+        if start > 0 and latex_source[start - 1] == "%":
+            position = start + 1
+            continue
+        closing = find("}", start + len(start_of_item))
+        # A bibtex item contains at least one character after the identifier.
+        if closing + 1 >= length:
+            break
+        end = min(find(start_of_item, closing + 2), find(END_OF_BIBLIOGRAPHY, closing + 2))
+        if end == length and latex_source.endswith("\n") and closing + 2 < length:
+            # Leave out the final newline.
+            end = length - 1
+        spans.append((start, end))
+        position = end
+    return spans
+
+
 def extract_bibtex_items(latex_source):
     """Extract all bibtex items in a LaTeX file which are not commented out."""
-    bibtex_item_regex = re.compile(r"""(?<!%)  # Lookbehind to check that the bibtex item is not commented out.
-                                (\\bibitem{.*?}.+?)  # Match the entire bibtex item.
-                                (?=\\bibitem{|\\end{thebibliography}|$)  # Match only until the next bibtex item, end of bibliography or end of line.
-                                """, re.DOTALL | re.VERBOSE)
-    return bibtex_item_regex.findall(latex_source)
+    return [latex_source[start:end] for start, end in extract_bibtex_item_spans(latex_source)]
+
+
+def iter_bibitem_commands(text):
+    """
+    Yield the start, end and identifier of every \\bibitem{identifier} command in text, in time linear in its length.
+
+    The identifier has to be closed on the same line.
+    """
+    find = next_occurrence_finder(text)
+    length = len(text)
+    position = 0
+    while True:
+        start = find(BIBITEM_COMMAND, position)
+        if start == length:
+            return
+        position = start + 1
+        brace = start + len(BIBITEM_COMMAND)
+        if not text.startswith("{", brace):
+            continue
+        closing = find("}", brace + 1)
+        if closing == length:
+            # No later command can be closed either.
+            return
+        if find("\n", brace + 1) < closing:
+            continue
+        yield start, closing + 1, text[brace + 1:closing]
+        position = closing + 1
 
 
 def extract_bibitem_identifier(bibtex_entry):
     """Extract the bibitem identifier for a bibtex item."""
-    try:
-        return re.search(r"\\bibitem{(.*?)}", bibtex_entry).group(1)
-    except AttributeError:
-        return None
+    for _, _, identifier in iter_bibitem_commands(bibtex_entry):
+        return identifier
+    return None
+
+
+# Linear time: the digits before the slash cannot contain the start of another DOI, and the rest never backtracks.
+DOI_REGEX = re.compile(r"""
+(10\.\d{4,}\/[^} \n]*)
+""", re.VERBOSE)
+# The start of an arXiv id in a url, an arXiv tag or an eprint tag, and the characters that can end it.
+ARXIV_ID_START_REGEX = re.compile(r"abs/|arxiv:|\\eprint{", re.IGNORECASE)
+ARXIV_ID_TERMINATORS = {"abs/": " }", "arxiv:": " }]", "\\eprint{": "}"}
+
+
+def extract_dois(bibtex_item):
+    """Extract all DOI's from a bibtex item, in order of appearance."""
+    return [doi.rstrip().rstrip(";%%") for doi in DOI_REGEX.findall(bibtex_item)]
 
 
 def extract_doi(bibtex_item):
     """Extract the DOI (singular) from a bibtex item."""
-    # TODO: Gracefully handle multiple DOI's in a given piece of text.
-    try:
-        doi_regex = re.compile(r"""
-        (10\.\d{4,}\/[^} \n]*)
-        """, re.VERBOSE)
-        doi = doi_regex.search(bibtex_item)
-        doi =  doi.group(1).rstrip()
-        return doi.rstrip(";%%")
-    except AttributeError:
-        return None
+    dois = extract_dois(bibtex_item)
+    return dois[0] if dois else None
+
+
+def extract_arxiv_ids(bibtex_item):
+    """Extract all arXiv id's from a bibtex item, in order of appearance, in time linear in its length."""
+    find = next_occurrence_finder(bibtex_item)
+    length = len(bibtex_item)
+    arxiv_ids = []
+    position = 0
+    while True:
+        match = ARXIV_ID_START_REGEX.search(bibtex_item, position)
+        if not match:
+            return arxiv_ids
+        prefix = match.group().lower()
+        start = match.end()
+        end = min(find(terminator, start) for terminator in ARXIV_ID_TERMINATORS[prefix])
+        newline = find("\n", start)
+        if prefix != "\\eprint{" and newline == length - 1:
+            # Urls and arXiv tags can also end at the end of the bibtex item, but not at any other newline.
+            end = min(end, newline)
+        if end > newline or (prefix == "\\eprint{" and end == length):
+            position = match.start() + 1
+            continue
+        arxiv_ids.append(bibtex_item[start:end].rstrip())
+        # The closing brace of an eprint tag is part of it.
+        position = end + 1 if prefix == "\\eprint{" else end
 
 
 def extract_arxiv_id(bibtex_item):
     """Extract the arXiv id for a bibtex item."""
-    try:
-        arxiv_id_regex = re.compile(r"""abs\/(.*?)(?=\ |}|$)  # Match in a url.
-                                    |arxiv:(.*?)(?=\ |}|$|])  # Match in a arXiv tag.
-                                    |\\eprint{(.*?)}          # Match in an eprint tag.
-                                    """, re.IGNORECASE | re.VERBOSE)
-        arxiv_id = arxiv_id_regex.search(bibtex_item)
-        # Find the group which has a match.
-        return list(filter(lambda x: x is not None, arxiv_id.groups()))[0].rstrip()
-    except AttributeError:
-        return None
+    arxiv_ids = extract_arxiv_ids(bibtex_item)
+    return arxiv_ids[0] if arxiv_ids else None
+
+
+def split_bibitem(bibitem_data):
+    """
+    Split a bibitem with multiple references, seperated by semicolons, into the individual references.
+
+    Parts without a DOI or arXiv id are kept together with the preceding reference,
+    so a bibitem with at most one identifier is never split.
+    """
+    # Semicolons can be part of a DOI, so do not split inside one.
+    doi_spans = [(doi.start(), doi.start() + len(doi.group(1).rstrip().rstrip(";%%"))) for doi in DOI_REGEX.finditer(bibitem_data)]
+    parts = []
+    start = 0
+    doi_number = 0
+    for semicolon in re.finditer(";", bibitem_data):
+        # Both the semicolons and the DOI's are in order of appearance.
+        while doi_number < len(doi_spans) and doi_spans[doi_number][1] <= semicolon.start():
+            doi_number += 1
+        if doi_number < len(doi_spans) and doi_spans[doi_number][0] <= semicolon.start():
+            continue
+        parts.append(bibitem_data[start:semicolon.start()])
+        start = semicolon.end()
+    parts.append(bibitem_data[start:])
+    references = []
+    for part in parts:
+        has_identifier = bool(extract_doi(part) or extract_arxiv_id(part))
+        if references and not (has_identifier and references[-1][1]):
+            references[-1][0].append(part)
+            references[-1][1] = references[-1][1] or has_identifier
+        else:
+            references.append([[part], has_identifier])
+    return [";".join(reference).strip() for reference, _ in references]
 
 
 def reformat_original_reference(original_reference):
     """Remove newlines, newblocks and extraneous whitespace from the original refere."""
-    text = re.sub(r"\\bibitem{(.*?)}|\\newblock", " ", original_reference)
+    pieces = []
+    position = 0
+    for start, end, _ in iter_bibitem_commands(original_reference):
+        pieces += [original_reference[position:start], " "]
+        position = end
+    pieces.append(original_reference[position:])
+    text = "".join(pieces).replace("\\newblock", " ")
     text = re.sub(r"\n", " ", text)
     text = re.sub(r" +", " ", text.strip())
     # text = re.sub(r"(\\eprint{.*?})", r"\n%\1\n", text)  # Comment out \eprint, since it's not provided by the bibstyle and makes LaTeX choke during compilation.
@@ -115,9 +237,39 @@ def remove_arxiv_id_version(arxiv_id):
     return re.sub("v\d$", "", arxiv_id)
 
 
+# Attributes of a Reference which are included in its record.
+RECORD_FIELDS = ["bibitem_identifier", "doi", "arxiv_id", "item_type", "full_authors", "abbreviated_authors", "title",
+                 "year", "journal", "short_journal", "volume", "issue", "page", "article_number", "publisher",
+                 "publisher_location", "isbn", "reformatted_original_reference", "formatted_reference",
+                 "index_confidence", "transient_error", "lookup_time"]
+
+
+def write_reference_records(lookup_reference, bibtex_entries, output, spans=None):
+    """
+    Look up bibitems and write a JSON record for each to output (one per line) as soon as it has been looked up.
+
+    The records are written in order of completion, with the position of the bibitem in the input as "index",
+    and its span in the LaTeX source as "source_span" (if spans are given).
+    """
+    def lookup(numbered_entry):
+        number, bibtex_entry = numbered_entry
+        return number, lookup_reference(bibtex_entry).record()
+
+    write_records(adaptive_imap_unordered(lookup, enumerate(bibtex_entries)), output, spans)
+
+
+def write_records(numbered_records, output, spans=None):
+    """Write records, given with the position of their bibitem in the input, to output as JSON lines (see write_reference_records)."""
+    for number, record in numbered_records:
+        record["index"] = number
+        record["source_span"] = spans[number] if spans else None
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        output.flush()
+
+
 class Reference:
     """Extract data for a bibtex entry, and reformat it for use in publications."""
-    def __init__(self, bibitem_data, add_arxiv=False):
+    def __init__(self, bibitem_data, add_arxiv=False, deadline=None, reference_index=None):
         self.bibitem_data = bibitem_data
         self.bibitem_identifier = None
         self.item_type = None
@@ -142,28 +294,125 @@ class Reference:
         self.formatted_reference = None
         self.reformatted_original_reference = None
         self.add_arxiv = add_arxiv
+        self.deadline = deadline
+        self.deadline_exceeded = False
+        self.transient_error = False
+        self.sub_references = None
+        self.reference_index = reference_index
+        self.index_confidence = None
+        self.lookup_time = None
 
     def main(self):
         """Extract DOI's and arXiv id's from a reference, and retrieve data, giving preference to Crossref data."""
+        start = time.monotonic()
         self.bibitem_identifier = extract_bibitem_identifier(self.bibitem_data)
-        split_bibdata = self.bibitem_data.split(";")
+        split_bibdata = split_bibitem(self.bibitem_data)
+        if len(split_bibdata) > 1:
+            self.resolve_sub_references(split_bibdata)
+        else:
+            self.resolve_reference()
+        self.lookup_time = time.monotonic() - start
+
+    def resolve_reference(self):
+        """Look up a bibitem containing a single reference."""
         self.doi = extract_doi(self.bibitem_data)
         self.arxiv_id = extract_arxiv_id(self.bibitem_data)
         self.reformatted_original_reference = reformat_original_reference(self.bibitem_data)
+        if not (self.doi or self.arxiv_id) and self.reference_index is not None:
+            self.find_in_index()
         if self.doi:
-            succes, crossref_data = open_webpage(f"https://api.crossref.org/works/{self.doi}", exit_on_error=False)
+            succes, crossref_data = self.fetch(f"https://api.crossref.org/works/{self.doi}")
             if succes:
                 self.crossref_data = crossref_data.json()["message"]
                 self.extract_crossref_reference_data()
         elif self.arxiv_id:
-            succes, arxiv_data = open_webpage(f"https://export.arxiv.org/api/query?id_list={remove_arxiv_id_version(self.arxiv_id)}", exit_on_error=False)
+            succes, arxiv_data = self.fetch(f"https://export.arxiv.org/api/query?id_list={remove_arxiv_id_version(self.arxiv_id)}")
             if succes:
                 self.arxiv_data = arxiv_data.text
                 self.extract_arxiv_reference_data()
         self.format_reference()
 
+    def resolve_sub_references(self, split_bibdata):
+        """Look up all references in a bibitem with multiple references concurrently, and join them in order."""
+        self.sub_references = [Reference(bibdata, self.add_arxiv, self.deadline, self.reference_index) for bibdata in split_bibdata]
+        adaptive_map(lambda reference: reference.main(), self.sub_references)
+        first_reference = self.sub_references[0]
+        self.doi = first_reference.doi
+        self.arxiv_id = first_reference.arxiv_id
+        self.reformatted_original_reference = reformat_original_reference(self.bibitem_data)
+        self.deadline_exceeded = any(reference.deadline_exceeded for reference in self.sub_references)
+        self.transient_error = any(reference.transient_error for reference in self.sub_references)
+        formatted_references = []
+        comments = []
+        for reference in self.sub_references:
+            # Move comments to the end, so they don't comment out the following references.
+            formatted_reference, _, comment = reference.formatted_reference.partition(" % ")
+            formatted_references.append(formatted_reference.rstrip("."))
+            if comment and comment not in comments:
+                comments.append(comment)
+        self.formatted_reference = "; ".join(formatted_references) + "."
+        if comments:
+            self.formatted_reference += " % " + " ".join(comments)
+
+    def find_in_index(self):
+        """Take the DOI or arXiv id from the best matching previously looked up reference, if the match is good enough."""
+        record, confidence = self.reference_index.search(self.reformatted_original_reference)
+        if confidence >= MATCH_THRESHOLD:
+            self.index_confidence = confidence
+            self.doi = record["doi"]
+            self.arxiv_id = record["arxiv_id"]
+
+    def timed_out(self):
+        """Return whether the reference could not be looked up because the deadline was reached."""
+        if self.sub_references:
+            return any(reference.timed_out() for reference in self.sub_references)
+        return self.deadline_exceeded and not (self.crossref_data or self.arxiv_data)
+
+    def status(self):
+        """Return the outcome of looking up the reference."""
+        if self.timed_out():
+            return "deadline_exceeded"
+        if self.sub_references:
+            statuses = {reference.status() for reference in self.sub_references}
+            return statuses.pop() if len(statuses) == 1 else "partially_resolved"
+        if self.crossref_data or self.arxiv_data:
+            return "resolved"
+        if self.doi or self.arxiv_id:
+            return "failed"
+        return "no_identifier"
+
+    def record(self):
+        """Return the data extracted for the reference as a dictionary, e.g. for JSON output."""
+        record = {field: getattr(self, field) for field in RECORD_FIELDS}
+        record["status"] = self.status()
+        if self.sub_references:
+            record["sub_references"] = [reference.record() for reference in self.sub_references]
+        return record
+
+    def fetch(self, address):
+        """
+        Open a webpage, taking into account the time left before the deadline (if there is one).
+
+        Records whether a failed request may succeed when it is tried again.
+        """
+        if self.deadline is None:
+            succes, response = open_webpage(address, exit_on_error=False)
+        elif self.deadline.expired():
+            self.deadline_exceeded = True
+            return False, None
+        else:
+            # Stragglers are hedged, so one slow response does not hold up the whole run.
+            succes, response = open_webpage(address, exit_on_error=False, timeout=self.deadline.timeout(), hedge=True)
+            if not succes and self.deadline.expired():
+                self.deadline_exceeded = True
+        if not succes:
+            self.transient_error = self.transient_error or is_transient_error(response)
+        return succes, response
+
     def extract_arxiv_reference_data(self):
         """Extract arXiv data for a reference, and the DOI information, if a DOI is available."""
+        # Imported here, since BeautifulSoup is slow to import and only needed for arXiv responses.
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(self.arxiv_data, "html5lib")
         self.title = re.sub(" +", " ", re.sub("\n", "", soup.entry.title.string.strip()))
         self.full_authors = [a.string for a in soup.find_all("name")]
@@ -174,7 +423,7 @@ class Reference:
         # Prefer DOI data if it is available.
         try:
             self.doi = soup.find_all("link", title='doi')[0]["href"].lstrip("http://dx.doi.org/")
-            succes, crossref_data = open_webpage(f"https://api.crossref.org/works/{self.doi}", exit_on_error=False)
+            succes, crossref_data = self.fetch(f"https://api.crossref.org/works/{self.doi}")
             if succes:
                 self.crossref_data = crossref_data.json()["message"]
                 self.extract_crossref_reference_data()
@@ -0,0 +1,117 @@
+"""Tests that the bibitem, identifier and citation scanners stay fast and correct on malformed and pathological input."""
+
+import os
+import random
+import re
+import tempfile
+import time
+import unittest
+
+from reference_utils import (extract_bibtex_items,
+                             extract_bibtex_item_spans,
+                             extract_bibitem_identifier,
+                             extract_dois,
+                             extract_arxiv_ids,
+                             split_bibitem,
+                             reformat_original_reference,
+                             iter_bibitem_commands)
+from bibtex_utils import extract_citation_keys, iter_bbl_bibitems
+
+# Size (in characters) of every adversarial input.
+INPUT_SIZE = 1000000
+# Maximum time (in seconds) that scanning an adversarial input may take.
+TIME_LIMIT = 2
+
+# The regular expressions which were replaced by the scanners, used to check that the results did not change.
+OLD_BIBTEX_ITEM_REGEX = re.compile(r"(?<!%)(\\bibitem{.*?}.+?)(?=\\bibitem{|\\end{thebibliography}|$)", re.DOTALL)
+OLD_BIBITEM_IDENTIFIER_REGEX = re.compile(r"\\bibitem{(.*?)}")
+OLD_ARXIV_ID_REGEX = re.compile(r"abs\/(.*?)(?=\ |}|$)|arxiv:(.*?)(?=\ |}|$|])|\\eprint{(.*?)}", re.IGNORECASE)
+OLD_CITE_REGEX = re.compile(r"\\(?:no)?cite[a-zA-Z]*\*?(?:\s*\[[^\]]*\]){0,2}\s*{([^}]*)}")
+# Pieces from which random LaTeX sources are built.
+FUZZ_TOKENS = ["\\bibitem{", "\\bibitem", "\\bibitem[", "\\end{thebibliography}", "\\newblock", "\\cite", "\\citep",
+               "\\nocite", "abs/", "ArXiv:", "\\eprint{", "10.1234/x;y", "{", "}", "[", "]", "%", "\n", " ", ",", "a", "b1"]
+
+
+def repeat(piece, end=""):
+    """Repeat a piece of text until the input is INPUT_SIZE characters long."""
+    return piece * ((INPUT_SIZE - len(end)) // len(piece)) + end
+
+
+def adversarial_inputs():
+    """Inputs on which backtracking regular expressions take time quadratic (or worse) in their length."""
+    return {"unterminated bibitems": repeat("\\bibitem{"),
+            "unterminated bibitem on every line": repeat("\\bibitem{a\n"),
+            "commented out bibitems": repeat("%\\bibitem{a} b"),
+            "missing end of bibliography": "\\begin{thebibliography}{99}\n\\bibitem{a} " + repeat("x"),
+            "megabyte-long line": repeat("A. Author, Title, J. Phys. A \\textbf{1}, 1 (2000). "),
+            "repeated urls": repeat("abs/", "\nx"),
+            "repeated arXiv tags": repeat("arXiv:", "\nx"),
+            "unterminated eprints": repeat("\\eprint{"),
+            "semicolon separated DOI's": repeat("10.1234/a;"),
+            "long DOI prefix": "10." + repeat("1"),
+            "unterminated citations": repeat("\\cite{"),
+            "unterminated notes": repeat("\\cite["),
+            "notes without keys": repeat("\\cite[a]"),
+            "unterminated labels": repeat("\\bibitem["),
+            "labels full of brackets": repeat("\\bibitem[{]]]]]]]"),
+            "unterminated label on every line": repeat("\\bibitem[{a\n")}
+
+
+def old_extract_citation_keys(latex_source):
+    latex_source = re.sub(r"(?<!\\)%.*", "", latex_source)
+    keys = {}
+    for citation in OLD_CITE_REGEX.findall(latex_source):
+        for key in citation.split(","):
+            if key.strip():
+                keys.setdefault(key.strip(), None)
+    return list(keys)
+
+
+def old_reformat_original_reference(original_reference):
+    text = re.sub(r"\\bibitem{(.*?)}|\\newblock", " ", original_reference)
+    return re.sub(r" +", " ", text.replace("\n", " ").strip())
+
+
+def read_bbl_bibitems(text):
+    """Read the bibitems of text written to a .bbl file."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        bbl_file = os.path.join(temp_dir, "references.bbl")
+        with open(bbl_file, "w", encoding="utf-8") as data:
+            data.write(text)
+        return list(iter_bbl_bibitems(bbl_file))
+
+
+class TestAdversarialInputs(unittest.TestCase):
+    def test_scanning_time(self):
+        scanners = [extract_bibtex_items, extract_bibitem_identifier, extract_dois, extract_arxiv_ids, split_bibitem,
+                    reformat_original_reference, extract_citation_keys,
+                    lambda text: list(iter_bibitem_commands(text)), read_bbl_bibitems]
+        for name, text in adversarial_inputs().items():
+            for scanner in scanners:
+                start = time.perf_counter()
+                scanner(text)
+                duration = time.perf_counter() - start
+                self.assertLess(duration, TIME_LIMIT, f"{scanner.__name__} took {duration:.1f} s on {name}")
+
+    def test_missing_end_of_bibliography(self):
+        latex_source = "\\begin{thebibliography}{99}\n\\bibitem{a} A\n\\bibitem{b} B" + "x" * 100000
+        self.assertEqual(extract_bibtex_items(latex_source), ["\\bibitem{a} A\n", "\\bibitem{b} B" + "x" * 100000])
+
+    def test_same_results_as_regular_expressions(self):
+        random_generator = random.Random(0)
+        for _ in range(5000):
+            text = "".join(random_generator.choice(FUZZ_TOKENS) for _ in range(random_generator.randint(0, 14)))
+            self.assertEqual(extract_bibtex_items(text), OLD_BIBTEX_ITEM_REGEX.findall(text), text)
+            self.assertEqual(extract_bibtex_item_spans(text), [item.span() for item in OLD_BIBTEX_ITEM_REGEX.finditer(text)], text)
+            identifier = OLD_BIBITEM_IDENTIFIER_REGEX.search(text)
+            self.assertEqual(extract_bibitem_identifier(text), identifier.group(1) if identifier else None, text)
+            self.assertEqual(extract_arxiv_ids(text), [next(group for group in arxiv_id.groups() if group is not None).rstrip()
+                                                       for arxiv_id in OLD_ARXIV_ID_REGEX.finditer(text)], text)
+            self.assertEqual(extract_citation_keys(text), old_extract_citation_keys(text), text)
+            self.assertEqual(reformat_original_reference(text), old_reformat_original_reference(text), text)
+            self.assertEqual(list(iter_bibitem_commands(text)),
+                             [(item.start(), item.end(), item.group(1)) for item in OLD_BIBITEM_IDENTIFIER_REGEX.finditer(text)], text)
+
+
+if __name__ == '__main__':
+    unittest.main()
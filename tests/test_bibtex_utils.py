@@ -0,0 +1,182 @@
+"""Tests for bibtex_utils.py"""
+
+import os
+import tempfile
+import time
+import unittest
+import warnings
+
+from bibtex_utils import (extract_citation_keys,
+                          index_bib_file,
+                          read_bib_entries,
+                          parse_bib_entry,
+                          format_bib_name,
+                          bib_entry_to_bibitem,
+                          iter_bbl_bibitems,
+                          read_cited_bibitems)
+
+TEST_BIB = """% A comment with an @article{fake, in it.
+@string{prb = "Phys. Rev. B"}
+
+@article{Caux2009,
+  author = {Caux, Jean-S{\\'e}bastien},
+  title = {{Correlation functions of integrable models: A description of the ABACUS algorithm}},
+  journal = {J. Math. Phys.},
+  volume = 50,
+  pages = {095214},
+  year = {2009},
+  doi = {10.1063/1.3216474}
+}
+
+@Article{Dubail2017, author = "Dubail, J. and Stéphan, J.-M. and Viti, J. and Calabrese, P.", title = "Conformal field theory for inhomogeneous one-dimensional quantum systems", journal = prb, year = 2017, eprint = {1606.04401}, archivePrefix = {arXiv}}
+
+@book{Uncited,
+  author = {Someone Else},
+  title = {A {Book} with \\{braces\\}},
+  publisher = {Publisher},
+  year = {1999}
+}
+"""
+
+TEST_BBL = """\\begin{thebibliography}{10}
+
+\\bibitem[Caux(2009)]{Caux2009}
+J.-S. Caux, \\newblock Correlation functions, \\doi{10.1063/1.3216474}.
+
+%\\bibitem{Commented} Not a reference.
+
+\\bibitem{Uncited}
+S. Else, A book.
+
+\\end{thebibliography}
+"""
+
+TEST_LATEX = """As shown in~\\cite[p.~2]{Dubail2017, Caux2009} and \\citep{Caux2009}.
+% \\cite{Uncited}
+See also \\cite{Missing}."""
+
+
+class TestBibtexUtils(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.bib_file = os.path.join(self.temp_dir.name, "references.bib")
+        self.bbl_file = os.path.join(self.temp_dir.name, "references.bbl")
+        with open(self.bib_file, "w", encoding="utf-8") as bib_file:
+            bib_file.write(TEST_BIB)
+        with open(self.bbl_file, "w", encoding="utf-8") as bbl_file:
+            bbl_file.write(TEST_BBL)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_citation_key_extraction(self):
+        """Test that cited keys are extracted in order of first citation, ignoring comments."""
+        self.assertEqual(extract_citation_keys(TEST_LATEX), ["Dubail2017", "Caux2009", "Missing"])
+        self.assertEqual(extract_citation_keys("\\nocite{*} 50\\% \\citet*{a,b}"), ["*", "a", "b"])
+
+    def test_bib_indexing(self):
+        """Test that entries are indexed by key and can be read back individually."""
+        index = index_bib_file(self.bib_file)
+        self.assertEqual(list(index), ["Caux2009", "Dubail2017", "Uncited"])
+        entries = read_bib_entries(self.bib_file, index, ["Uncited", "Missing"])
+        self.assertEqual(list(entries), ["Uncited"])
+        self.assertTrue(entries["Uncited"].startswith("@book{Uncited,"))
+        self.assertTrue(entries["Uncited"].endswith("}\n"))
+
+    def test_unbalanced_bib_entry(self):
+        """Test that an entry with unbalanced braces ends where the next entry starts, with a warning."""
+        with open(self.bib_file, "w", encoding="utf-8") as bib_file:
+            bib_file.write("@article{a, title={Unbalanced {brace}, year={2000}}\n"
+                           "@article{b, title={B}}\n@string{c = {C}}\n@article{c,\n  title={C}}\n@misc{d, title={{D}}\n")
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            index = index_bib_file(self.bib_file)
+        self.assertEqual(list(index), ["a", "b", "c", "d"])
+        self.assertEqual([str(warning.message).split(" in ")[0] for warning in caught],
+                         ["The braces of entry a", "The braces of entry d"])
+        entries = read_bib_entries(self.bib_file, index, index)
+        self.assertEqual(entries["a"], "@article{a, title={Unbalanced {brace}, year={2000}}\n")
+        self.assertEqual(entries["c"], "@article{c,\n  title={C}}\n")
+
+    def test_bib_entry_parsing(self):
+        """Test that the fields of BibTeX entries are correctly parsed."""
+        index = index_bib_file(self.bib_file)
+        entries = read_bib_entries(self.bib_file, index, index)
+        entry_type, key, fields = parse_bib_entry(entries["Caux2009"])
+        self.assertEqual((entry_type, key), ("article", "Caux2009"))
+        self.assertEqual(fields["title"], "{Correlation functions of integrable models: A description of the ABACUS algorithm}")
+        self.assertEqual(fields["volume"], "50")
+        self.assertEqual(fields["doi"], "10.1063/1.3216474")
+        entry_type, key, fields = parse_bib_entry(entries["Dubail2017"])
+        self.assertEqual(fields["author"], "Dubail, J. and Stéphan, J.-M. and Viti, J. and Calabrese, P.")
+        self.assertEqual(fields["journal"], "prb")
+        self.assertEqual(fields["archiveprefix"], "arXiv")
+        self.assertEqual(parse_bib_entry(entries["Uncited"])[2]["title"], "A {Book} with \\{braces\\}")
+
+    def test_bib_name_formatting(self):
+        """Test that BibTeX names are written as first name followed by last name."""
+        self.assertEqual(format_bib_name("Caux, Jean-S{\\'e}bastien"), "Jean-S\\'ebastien Caux")
+        self.assertEqual(format_bib_name("van Wezel, Jasper"), "Jasper van Wezel")
+        self.assertEqual(format_bib_name("Jasper van Wezel"), "Jasper van Wezel")
+
+    def test_bib_entry_conversion(self):
+        """Test that BibTeX entries are converted to bibitems with the identifiers the other tools look for."""
+        index = index_bib_file(self.bib_file)
+        entries = read_bib_entries(self.bib_file, index, index)
+        self.assertEqual(bib_entry_to_bibitem(entries["Caux2009"]),
+                         "\\bibitem{Caux2009} Jean-S\\'ebastien Caux, \\textit{{Correlation functions of integrable models: "
+                         "A description of the ABACUS algorithm}}, J. Math. Phys. \\textbf{50}, 095214 (2009), \\doi{10.1063/1.3216474}.")
+        self.assertEqual(bib_entry_to_bibitem(entries["Dubail2017"]),
+                         "\\bibitem{Dubail2017} J. Dubail, J.-M. Stéphan, J. Viti and P. Calabrese, \\textit{Conformal field theory "
+                         "for inhomogeneous one-dimensional quantum systems}, prb (2017), arXiv:1606.04401.")
+
+    def test_bbl_reading(self):
+        """Test that bibitems are read from a .bbl file, without natbib labels and commented out bibitems."""
+        self.assertEqual(list(iter_bbl_bibitems(self.bbl_file)),
+                         ["\\bibitem{Caux2009}\nJ.-S. Caux, \\newblock Correlation functions, \\doi{10.1063/1.3216474}.\n\n\n",
+                          "\\bibitem{Uncited}\nS. Else, A book.\n\n"])
+
+    def test_bbl_labels(self):
+        """Test that bibitems are read with natbib labels wrapped onto the next line and with spaces before the label."""
+        with open(self.bbl_file, "w", encoding="utf-8") as bbl_file:
+            bbl_file.write("\\begin{thebibliography}{2}\n"
+                           "\\bibitem[{Abadi et~al.(2016)Abadi, Barham, Chen, Chen, Davis, Dean, Devin,\n"
+                           "  Ghemawat, Irving, Isard et~al.}]{abadi2016}\n"
+                           "M. Abadi, TensorFlow.\n\n"
+                           "\\bibitem [{Caux(2009)}]{Caux2009}%\n"
+                           "  \\BibitemOpen\n  J.-S. Caux, Correlation functions.\n"
+                           "\\bibitem\n  {Else}\n  S. Else, A book.\n"
+                           "\\end{thebibliography}\n")
+        self.assertEqual(list(iter_bbl_bibitems(self.bbl_file)),
+                         ["\\bibitem{abadi2016}\nM. Abadi, TensorFlow.\n\n",
+                          "\\bibitem{Caux2009}%\n  \\BibitemOpen\n  J.-S. Caux, Correlation functions.\n",
+                          "\\bibitem{Else}\n  S. Else, A book.\n"])
+
+    def test_cited_bibitems(self):
+        """Test that only the cited references are read, and that missing references are reported."""
+        bibitems, missing_keys = read_cited_bibitems(self.bib_file, TEST_LATEX)
+        self.assertEqual([bibitem.split("}")[0] for bibitem in bibitems], ["\\bibitem{Dubail2017", "\\bibitem{Caux2009"])
+        self.assertEqual(missing_keys, ["Missing"])
+        bibitems, missing_keys = read_cited_bibitems(self.bbl_file, TEST_LATEX)
+        self.assertEqual([bibitem.split("}")[0] for bibitem in bibitems], ["\\bibitem{Caux2009"])
+        self.assertEqual(missing_keys, ["Dubail2017", "Missing"])
+        bibitems, missing_keys = read_cited_bibitems(self.bib_file, "\\nocite{*}")
+        self.assertEqual(len(bibitems), 3)
+        self.assertEqual(missing_keys, [])
+
+    def test_large_bib_file(self):
+        """Test that reading a few cited references from a large .bib file only parses those references."""
+        large_bib_file = os.path.join(self.temp_dir.name, "large.bib")
+        with open(large_bib_file, "w", encoding="utf-8") as bib_file:
+            for i in range(20000):
+                bib_file.write(f"@article{{key{i},\n  author = {{Author, A.}},\n  title = {{Title {i}}},\n  year = {{2000}}\n}}\n\n")
+        latex_source = " ".join(f"\\cite{{key{i}}}" for i in range(0, 20000, 333))
+        start = time.perf_counter()
+        bibitems, missing_keys = read_cited_bibitems(large_bib_file, latex_source)
+        self.assertLess(time.perf_counter() - start, 2)
+        self.assertEqual(len(bibitems), 61)
+        self.assertEqual(bibitems[1], "\\bibitem{key333} A. Author, \\textit{Title 333} (2000).")
+
+
+if __name__ == "__main__":
+    unittest.main(buffer=True, verbosity=2)
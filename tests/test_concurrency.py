@@ -0,0 +1,203 @@
+"""Tests for concurrency.py"""
+
+import threading
+import time
+import unittest
+
+from concurrency import (get_host,
+                         HostLimiter,
+                         ConcurrencyController,
+                         Deadline,
+                         REQUEST_TIMEOUT,
+                         HEDGE_MIN_SAMPLES,
+                         request_slot,
+                         adaptive_map,
+                         adaptive_imap_unordered,
+                         hedged_call)
+
+
+class TestHostLimiter(unittest.TestCase):
+    def test_host_extraction(self):
+        """Test that the host of a web address is correctly extracted."""
+        self.assertEqual(get_host("https://api.crossref.org/works/10.21468/SciPostPhys.2.2.015"), "api.crossref.org")
+        self.assertEqual(get_host("https://export.arxiv.org/api/query?id_list=1608.02869"), "export.arxiv.org")
+
+    def test_additive_increase(self):
+        """Test that fast successful requests slowly increase the limit, up to the maximum."""
+        limiter = HostLimiter("example.com", initial_limit=2, max_limit=3)
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(0.1)
+        self.assertEqual(limiter.limit, 3)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(0.1)
+        self.assertEqual(limiter.limit, 3)
+
+    def test_multiplicative_decrease(self):
+        """Test that throttling, errors and slow responses decrease the limit, down to the minimum."""
+        limiter = HostLimiter("example.com", initial_limit=16, max_limit=32)
+        limiter.acquire()
+        limiter.release(0.1, error=True, throttled=True)
+        self.assertEqual(limiter.limit, 8)
+        limiter.acquire()
+        limiter.release(0.1, error=True)
+        self.assertEqual(limiter.limit, 6)
+        limiter.acquire()
+        limiter.release(limiter.target_latency + 1)
+        self.assertAlmostEqual(limiter.limit, 5.4)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(0.1, error=True, throttled=True)
+        self.assertEqual(limiter.limit, 1)
+        self.assertEqual((limiter.requests, limiter.errors, limiter.throttled), (13, 1, 11))
+
+    def test_throttling_burst(self):
+        """Test that a burst of throttled responses to concurrent requests cuts the limit only once."""
+        controller = ConcurrencyController(host_limits={"example.com": (48, 48)})
+        barrier = threading.Barrier(48)
+
+        def request(_):
+            with request_slot("https://example.com/", controller) as outcome:
+                # All requests are in flight before the first response arrives.
+                barrier.wait()
+                outcome.failed(429)
+
+        adaptive_map(request, range(48), controller)
+        limiter = controller.limiter("https://example.com/")
+        self.assertEqual((limiter.limit, limiter.throttled), (24, 48))
+        # Requests sent after the cut can cut the limit again.
+        with request_slot("https://example.com/", controller) as outcome:
+            outcome.failed(429)
+        self.assertEqual(limiter.limit, 12)
+
+    def test_limit_is_enforced(self):
+        """Test that no more requests than the limit are in flight at the same time."""
+        controller = ConcurrencyController(host_limits={"example.com": (2, 2)})
+        in_flight = []
+        lock = threading.Lock()
+
+        def request(_):
+            with request_slot("https://example.com/", controller):
+                with lock:
+                    in_flight.append(controller.limiter("https://example.com/").in_flight)
+                time.sleep(0.01)
+
+        adaptive_map(request, range(10), controller)
+        self.assertEqual(max(in_flight), 2)
+        self.assertEqual(controller.limits(), {"example.com": 2})
+
+    def test_failed_request_is_recorded(self):
+        """Test that exceptions inside a request slot release the slot."""
+        controller = ConcurrencyController()
+        with self.assertRaises(SystemExit):
+            with request_slot("https://example.com/", controller) as outcome:
+                outcome.failed(429)
+                raise SystemExit
+        limiter = controller.limiter("https://example.com/")
+        self.assertEqual((limiter.in_flight, limiter.throttled), (0, 1))
+        self.assertIn("example.com: limit 2", controller.report())
+
+
+class TestAdaptiveMap(unittest.TestCase):
+    def test_order_is_preserved(self):
+        """Test that results are returned in the order of the input."""
+        self.assertEqual(adaptive_map(lambda x: x ** 2, range(100)), [x ** 2 for x in range(100)])
+
+    def test_results_in_order_of_completion(self):
+        """Test that results are yielded as soon as they are available."""
+        self.assertEqual(list(adaptive_imap_unordered(lambda x: time.sleep(x) or x, [0.2, 0.1, 0])), [0, 0.1, 0.2])
+        self.assertEqual(list(adaptive_imap_unordered(lambda x: x, [1])), [1])
+
+    def test_small_inputs_run_inline(self):
+        """Test that a single item is processed without starting worker threads."""
+        self.assertEqual(adaptive_map(lambda _: threading.current_thread(), [1]), [threading.current_thread()])
+        self.assertEqual(adaptive_map(lambda x: x, []), [])
+
+
+class TestDeadlines(unittest.TestCase):
+    def test_deadline(self):
+        """Test that request timeouts shrink as the deadline approaches."""
+        self.assertEqual(Deadline(1000).timeout(), REQUEST_TIMEOUT)
+        self.assertLessEqual(Deadline(1).timeout(), 1)
+        self.assertFalse(Deadline(1).expired())
+        self.assertTrue(Deadline(0).expired())
+        self.assertEqual(Deadline(-1).timeout(), 0)
+
+    def test_slot_timeout(self):
+        """Test that waiting for a request slot gives up after the timeout."""
+        controller = ConcurrencyController(host_limits={"example.com": (1, 1)})
+        with request_slot("https://example.com/", controller):
+            with self.assertRaises(TimeoutError):
+                with request_slot("https://example.com/", controller, timeout=0.01):
+                    pass
+
+    def test_hedge_delay(self):
+        """Test that requests are only hedged once enough latencies have been observed."""
+        limiter = HostLimiter("example.com", initial_limit=1, max_limit=1)
+        for i in range(HEDGE_MIN_SAMPLES):
+            self.assertIsNone(limiter.hedge_delay())
+            limiter.acquire()
+            limiter.release(i / 100)
+        self.assertEqual(limiter.hedge_delay(), (HEDGE_MIN_SAMPLES - 1) / 100)
+
+    def test_hedged_call(self):
+        """Test that a straggling call is hedged, and that the first successful result is used."""
+        calls = []
+
+        def straggler(cancelled):
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                time.sleep(1)
+                return "first"
+            return "hedge"
+
+        start = time.monotonic()
+        self.assertEqual(hedged_call(straggler, 0.01), "hedge")
+        self.assertLess(time.monotonic() - start, 0.5)
+        # Calls which return in time are not hedged.
+        calls = []
+        self.assertEqual(hedged_call(lambda cancelled: calls.append(1) or "result", 1), "result")
+        self.assertEqual(calls, [1])
+        self.assertEqual(hedged_call(lambda cancelled: "result", None), "result")
+
+    def test_hedged_call_cancellation(self):
+        """Test that the slower of two hedged calls is called off once the result of the other one is used."""
+        events = []
+
+        def call(cancelled):
+            events.append(cancelled)
+            if len(events) == 1:
+                time.sleep(0.05)
+                return "first"
+            # The hedge waits (e.g. for a request slot) until it is called off.
+            return "hedge" if cancelled.wait(1) else "not called off"
+
+        self.assertEqual(hedged_call(call, 0.01), "first")
+        self.assertEqual(len(events), 2)
+        self.assertTrue(events[1].wait(1))
+
+    def test_hedged_call_failures(self):
+        """Test that a failing first call is hedged by a successful second call, and that double failures are raised."""
+        calls = []
+
+        def fail_first(cancelled):
+            calls.append(1)
+            if len(calls) == 1:
+                time.sleep(0.05)
+                raise ConnectionError("First call failed.")
+            time.sleep(0.1)
+            return "hedge"
+
+        self.assertEqual(hedged_call(fail_first, 0.01), "hedge")
+
+        def fail(cancelled):
+            time.sleep(0.02)
+            raise ConnectionError("Call failed.")
+
+        with self.assertRaises(ConnectionError):
+            hedged_call(fail, 0.01)
+
+
+if __name__ == "__main__":
+    unittest.main(buffer=True, verbosity=2)
@@ -0,0 +1,163 @@
+"""Tests for job_queue.py"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from concurrency import Deadline
+from job_queue import MAX_ATTEMPTS, JobQueue, get_job_id, lookup_queued_references, work
+from reference_formatter import ReferenceFormatter
+from reference_scraper import get_queued_references
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Bibitems without a DOI or arXiv id, which are looked up without accessing the network.
+TEST_BIBITEMS = [f"\\bibitem{{ref{number}}} A. Author, Some title {number}, J. Phys. A \\textbf{{1}}, {number} (2000).\n"
+                 for number in range(30)]
+
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.queue_file = os.path.join(self.temp_dir.name, "queue.sqlite")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_enqueue(self):
+        """Test that identical jobs are only added once, with the same id on every host."""
+        job_queue = JobQueue(self.queue_file)
+        payloads = [{"bibitem": "a", "add_arxiv": False}, {"bibitem": "b", "add_arxiv": False}, {"add_arxiv": False, "bibitem": "a"}]
+        job_ids = job_queue.enqueue(payloads)
+        self.assertEqual(job_ids, [get_job_id(payloads[0]), get_job_id(payloads[1]), get_job_id(payloads[0])])
+        job_queue.enqueue(payloads[:1])
+        self.assertEqual(job_queue.counts(), {"pending": 2})
+        job_queue.close()
+
+    def test_leasing(self):
+        """Test that a job is claimed by one worker at a time, and can be taken over when its lease expires."""
+        job_queue = JobQueue(self.queue_file)
+        job_id = job_queue.enqueue([{"bibitem": "a"}])[0]
+        self.assertEqual(job_queue.claim("worker 1"), (job_id, {"bibitem": "a"}, 1))
+        self.assertIsNone(job_queue.claim("worker 2"))
+        expiring_queue = JobQueue(self.queue_file, lease_duration=0)
+        job_queue.enqueue([{"bibitem": "b"}])
+        self.assertEqual(expiring_queue.claim("worker 2")[2], 1)
+        # The job of a crashed worker is claimed again.
+        self.assertEqual(expiring_queue.claim("worker 3")[:2], (get_job_id({"bibitem": "b"}), {"bibitem": "b"}))
+        self.assertFalse(expiring_queue.complete(get_job_id({"bibitem": "b"}), "worker 2", {"title": "B"}))
+        self.assertTrue(expiring_queue.complete(get_job_id({"bibitem": "b"}), "worker 3", {"title": "B"}))
+        self.assertTrue(job_queue.complete(job_id, "worker 1", {"title": "A"}))
+        self.assertEqual(job_queue.results([job_id]), {job_id: ("done", {"title": "A"})})
+        job_queue.close()
+        expiring_queue.close()
+
+    def test_retries(self):
+        """Test that failed jobs are retried until the maximum number of attempts, and again when enqueued again."""
+        job_queue = JobQueue(self.queue_file, max_attempts=2, retry_delay=0)
+        job_id = job_queue.enqueue([{"bibitem": "a"}])[0]
+        for attempt in [1, 2]:
+            self.assertEqual(job_queue.claim("worker")[2], attempt)
+            self.assertTrue(job_queue.release(job_id, "worker", "Timeout"))
+        self.assertIsNone(job_queue.claim("worker"))
+        self.assertEqual(job_queue.results([job_id]), {job_id: ("failed", None)})
+        job_queue.enqueue([{"bibitem": "a"}])
+        # Leases which keep expiring are given up on as well.
+        expiring_queue = JobQueue(self.queue_file, lease_duration=0, max_attempts=2)
+        self.assertEqual(expiring_queue.claim("worker 1")[2], 1)
+        self.assertEqual(expiring_queue.claim("worker 2")[2], 2)
+        self.assertIsNone(expiring_queue.claim("worker 3"))
+        self.assertEqual(expiring_queue.counts(), {"failed": 1})
+        job_queue.close()
+        expiring_queue.close()
+
+    def test_failed_lookups(self):
+        """Test that a job fails with the record of its last lookup if this failed, and is retried when enqueued again."""
+        job_queue = JobQueue(self.queue_file)
+        payload = {"bibitem": TEST_BIBITEMS[0].rstrip(), "add_arxiv": False}
+        job_id = job_queue.enqueue([payload])[0]
+        job_queue.connection.execute("UPDATE jobs SET attempts = ?", (MAX_ATTEMPTS - 1,))
+        failed_record = {"bibitem_identifier": "ref0", "doi": "10.1088/1751-8113/1/1/001", "status": "failed", "transient_error": True}
+        with mock.patch("job_queue.lookup_payload", return_value=failed_record):
+            worker = threading.Timer(0.1, work, args=(self.queue_file, "worker"), kwargs={"exit_when_empty": True})
+            worker.start()
+            records = list(lookup_queued_references(job_queue, TEST_BIBITEMS[:1], deadline=Deadline(30), poll_interval=0.01))
+            worker.join()
+        self.assertEqual(records, [(0, failed_record)])
+        self.assertEqual(job_queue.results([job_id]), {job_id: ("failed", failed_record)})
+        job_queue.enqueue([payload])
+        self.assertEqual(job_queue.results([job_id]), {job_id: ("pending", None)})
+        job_queue.close()
+
+    def test_permanent_errors(self):
+        """Test that a lookup which failed on an error that does not go away (e.g. an unknown DOI) is not retried."""
+        job_queue = JobQueue(self.queue_file)
+        job_id = job_queue.enqueue([{"bibitem": TEST_BIBITEMS[0].rstrip(), "add_arxiv": False}])[0]
+        failed_record = {"bibitem_identifier": "ref0", "doi": "10.1088/1751-8113/1/1/001", "status": "failed", "transient_error": False}
+        with mock.patch("job_queue.lookup_payload", return_value=failed_record):
+            self.assertEqual(work(self.queue_file, "worker", exit_when_empty=True), 1)
+        self.assertEqual(job_queue.results([job_id]), {job_id: ("done", failed_record)})
+        self.assertEqual(job_queue.connection.execute("SELECT attempts FROM jobs").fetchone(), (1,))
+        job_queue.close()
+
+    def test_failed_jobs(self):
+        """Test that a job which failed without a lookup gives an unresolved record, which is marked by the formatter."""
+        job_queue = JobQueue(self.queue_file)
+        job_queue.enqueue([{"bibitem": TEST_BIBITEMS[0].rstrip(), "add_arxiv": False}])
+        job_queue.connection.execute("UPDATE jobs SET attempts = ?", (MAX_ATTEMPTS - 1,))
+        with mock.patch("job_queue.lookup_payload", side_effect=ConnectionError):
+            worker = threading.Timer(0.1, work, args=(self.queue_file, "worker"), kwargs={"exit_when_empty": True})
+            worker.start()
+            records = list(lookup_queued_references(job_queue, TEST_BIBITEMS[:1], deadline=Deadline(30), poll_interval=0.01))
+            worker.join()
+        self.assertEqual([(number, record["bibitem_identifier"], record["status"]) for number, record in records],
+                         [(0, "ref0", "queue_failed")])
+        formatter = ReferenceFormatter(False, job_queue=job_queue)
+        self.assertEqual(formatter.format_bibitem((TEST_BIBITEMS[0].rstrip(), "ref0", None, None, "queue_failed")),
+                         f"{TEST_BIBITEMS[0].rstrip()}\n%UNRESOLVED: the workers of the job queue failed to look up this reference.")
+        job_queue.close()
+
+    def test_worker(self):
+        """Test that a worker looks up all jobs, and the coordinator gets the records in the order of the bibitems."""
+        job_queue = JobQueue(self.queue_file)
+        job_queue.enqueue([{"bibitem": bibitem.rstrip(), "add_arxiv": False} for bibitem in TEST_BIBITEMS[:3]])
+        self.assertEqual(work(self.queue_file, "worker", exit_when_empty=True), 3)
+        records = sorted(lookup_queued_references(job_queue, TEST_BIBITEMS[:3]), key=lambda numbered_record: numbered_record[0])
+        self.assertEqual([(number, record["bibitem_identifier"], record["status"]) for number, record in records],
+                         [(0, "ref0", "no_identifier"), (1, "ref1", "no_identifier"), (2, "ref2", "no_identifier")])
+        self.assertEqual(get_queued_references(job_queue, TEST_BIBITEMS[:1]), [[(None, None, TEST_BIBITEMS[0].rstrip())]])
+        formatter = ReferenceFormatter(False, job_queue=job_queue)
+        self.assertEqual(formatter.get_references(TEST_BIBITEMS[1:2])[0][:3],
+                         (TEST_BIBITEMS[1].rstrip(), "ref1", TEST_BIBITEMS[1][len("\\bibitem{ref1} "):].rstrip()))
+        job_queue.close()
+
+    def test_deadline(self):
+        """Test that bibitems which have not been looked up before the deadline are returned as unresolved."""
+        job_queue = JobQueue(self.queue_file)
+        bibitem = "\\bibitem{a} A. Author, J. Phys. A \\textbf{1}, 1 (2000), \\doi{10.1088/1751-8113/1/1/001}."
+        records = list(lookup_queued_references(job_queue, [bibitem], deadline=Deadline(0)))
+        self.assertEqual([(number, record["doi"], record["status"]) for number, record in records],
+                         [(0, "10.1088/1751-8113/1/1/001", "deadline_exceeded")])
+        formatter = ReferenceFormatter(False, deadline=Deadline(0), job_queue=job_queue)
+        self.assertEqual(formatter.get_references([bibitem])[0][4], "deadline_exceeded")
+        job_queue.close()
+
+    def test_worker_processes(self):
+        """Test that several worker processes share the jobs, without looking up any job twice."""
+        job_queue = JobQueue(self.queue_file)
+        job_ids = job_queue.enqueue([{"bibitem": bibitem.rstrip(), "add_arxiv": False} for bibitem in TEST_BIBITEMS])
+        workers = [subprocess.Popen([sys.executable, "job_queue.py", self.queue_file, "--threads", "2", "--exit_when_empty"],
+                                    cwd=REPOSITORY_ROOT, stdout=subprocess.DEVNULL) for _ in range(3)]
+        for worker in workers:
+            self.assertEqual(worker.wait(timeout=60), 0)
+        self.assertEqual(job_queue.counts(), {"done": len(TEST_BIBITEMS)})
+        attempts = job_queue.connection.execute("SELECT job_id, attempts FROM jobs").fetchall()
+        self.assertEqual(sorted(attempts), sorted((job_id, 1) for job_id in job_ids))
+        job_queue.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,26 @@
 """Tests for LaTeX utilities."""
 
+import os
+import tempfile
+import threading
+import tracemalloc
 import unittest
+from unittest import mock
 
+import requests
+
+from concurrency import CONTROLLER
 from latex_utils import (get_relevant_warnings,
+                         get_webpage,
+                         read_latex_file,
                          remove_accented_characters,
-                         open_webpage)
+                         open_webpage,
+                         read_bibliography_regions,
+                         splice_latex_file)
+
+TEST_DOCUMENT = ("\\documentclass{article}\n\\begin{document}\nCaux~\\cite{Caux}.\n"
+                 "\\begin{thebibliography}{9}\n\\bibitem{Caux} J.-S. Caux, J. Math. Phys. \\textbf{50}, 095214 (2009).\n"
+                 "\\end{thebibliography}\n\\end{document}\n")
 
 
 class TestLaTeXUtils(unittest.TestCase):
@@ -34,3 +50,93 @@ class TestLaTeXUtils(unittest.TestCase):
         self.assertFalse(open_webpage("http://example.com/404", exit_on_error=False)[0])
         # Test succesfull connection to site.
         self.assertEqual(open_webpage("http://example.com/")[1].status_code, 200)
+
+
+    def test_request_timeout(self):
+        """Test that the time spent waiting for a request slot is taken from the request timeout."""
+        address = "https://slots.example.org/"
+        limiter = CONTROLLER.limiter(address)
+        slots = 0
+        while limiter.acquire(0):
+            slots += 1
+        threading.Timer(0.3, limiter.cancel).start()
+        with mock.patch("requests.get") as get:
+            self.assertTrue(open_webpage(address, timeout=1)[0])
+        self.assertLess(get.call_args[1]["timeout"], 0.8)
+        # Without a free slot before the timeout, no request is sent or recorded.
+        while limiter.acquire(0):
+            slots += 1
+        with mock.patch("requests.get") as get:
+            success, error = open_webpage(address, exit_on_error=False, timeout=0.2)
+        self.assertFalse(success)
+        self.assertIsInstance(error, (requests.exceptions.Timeout, TimeoutError))
+        get.assert_not_called()
+        for _ in range(slots - 1):
+            limiter.cancel()
+        self.assertEqual((limiter.in_flight, limiter.requests), (0, 1))
+        # A hedged request which is called off once it has a slot is not sent or recorded either.
+        cancelled = threading.Event()
+        cancelled.set()
+        with mock.patch("requests.get") as get:
+            self.assertIsNone(get_webpage(address, cancelled=cancelled))
+        get.assert_not_called()
+        self.assertEqual((limiter.in_flight, limiter.requests), (0, 1))
+
+    def test_bibliography_region_reading(self):
+        """Test that only the thebibliography environments of a LaTeX file are read."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            latex_file = os.path.join(temp_dir, "test.tex")
+            # Byte offsets differ from character offsets after a non-ASCII character.
+            prefix = "Sébastien\n".encode("utf-8")
+            with open(latex_file, "wb") as data:
+                data.write(prefix + TEST_DOCUMENT.encode("utf-8") + "\\begin{thebibliography}{9}\n\\bibitem{b} Jérôme".encode("latin-1"))
+            regions = read_bibliography_regions(latex_file)
+            start, end = TEST_DOCUMENT.index("\\begin{thebibliography}"), TEST_DOCUMENT.index("\n\\end{document}")
+            # The file is not valid UTF-8, so every environment is decoded as latin-1.
+            self.assertEqual(regions[0], (len(prefix) + start, len(prefix) + end, TEST_DOCUMENT[start:end], "latin-1"))
+            # An environment which is not closed runs until the end of the file.
+            self.assertEqual(regions[1][2:], ("\\begin{thebibliography}{9}\n\\bibitem{b} Jérôme", "latin-1"))
+            self.assertEqual(len(regions), 2)
+            open(latex_file, "w").close()
+            self.assertEqual(read_bibliography_regions(latex_file), [])
+
+    def test_bibliography_encoding(self):
+        """Test that non-ASCII text is spliced into an ASCII bibliography in the encoding of the rest of the file."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            latex_file = os.path.join(temp_dir, "test.tex")
+            with open(latex_file, "w", encoding="latin-1") as data:
+                data.write(TEST_DOCUMENT.replace("Caux~", "Café, Caux~"))
+            regions = [(start, end, text.replace("J.-S. Caux", "M. Krüger"), encoding)
+                       for start, end, text, encoding in read_bibliography_regions(latex_file)]
+            self.assertEqual(regions[0][3], "latin-1")
+            splice_latex_file(latex_file, regions)
+            self.assertEqual(read_latex_file(latex_file), TEST_DOCUMENT.replace("Caux~", "Café, Caux~").replace("J.-S. Caux", "M. Krüger"))
+
+    def test_bibliography_splicing(self):
+        """Test that new bibliographies are spliced into a LaTeX file, leaving the rest of it untouched."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            latex_file = os.path.join(temp_dir, "test.tex")
+            with open(latex_file, "w", encoding="utf-8") as data:
+                data.write(TEST_DOCUMENT + TEST_DOCUMENT)
+            regions = [(start, end, text.replace("J.-S. Caux", "Jean-Sébastien Caux"), encoding)
+                       for start, end, text, encoding in read_bibliography_regions(latex_file)]
+            splice_latex_file(latex_file, regions)
+            with open(latex_file, encoding="utf-8") as data:
+                self.assertEqual(data.read(), 2 * TEST_DOCUMENT.replace("J.-S. Caux", "Jean-Sébastien Caux"))
+            self.assertEqual(os.listdir(temp_dir), ["test.tex"])
+
+    def test_bibliography_memory_use(self):
+        """Test that the memory needed to rewrite the bibliography does not depend on the size of the LaTeX file."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            latex_file = os.path.join(temp_dir, "test.tex")
+            with open(latex_file, "w", encoding="utf-8") as data:
+                data.write(TEST_DOCUMENT.replace("\\begin{document}\n", "\\begin{document}\n" + "% Embedded data.\n" * 2000000))
+            tracemalloc.start()
+            try:
+                regions = read_bibliography_regions(latex_file)
+                splice_latex_file(latex_file, [(start, end, text.upper(), encoding) for start, end, text, encoding in regions])
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.assertGreater(os.path.getsize(latex_file), 30000000)
+            self.assertLess(peak, 5000000)
@@ -0,0 +1,26 @@
+"""Tests for reference_formatter.py"""
+
+import unittest
+
+from concurrency import Deadline
+from reference_formatter import ReferenceFormatter
+
+TEST_LATEX = ("\\begin{thebibliography}{9}\n"
+              "\\bibitem{tba1} A.~Zamolodchikov, Nucl. Phys. B {\\bf 342}, 695 (1990), \\doi{10.1016/0550-3213(90)90333-9}.\n\n"
+              "\\bibitem{test} F. Rizzo, \\emph{Some title}, arXiv:1608.02869\n"
+              "\\end{thebibliography}\n")
+
+
+class TestReferenceFormatter(unittest.TestCase):
+    def test_unresolved_references(self):
+        """Test that unresolved bibitems keep their text and a single marker, also when they are formatted again."""
+        formatter = ReferenceFormatter(False, deadline=Deadline(0))
+        formatted_latex = formatter.format_references(TEST_LATEX)
+        self.assertEqual(formatted_latex.count("%UNRESOLVED:"), 2)
+        self.assertIn("\\doi{10.1016/0550-3213(90)90333-9}.\n%UNRESOLVED:", formatted_latex)
+        self.assertIn("arXiv:1608.02869\n%UNRESOLVED:", formatted_latex)
+        self.assertEqual(formatter.format_references(formatted_latex), formatted_latex)
+
+
+if __name__ == '__main__':
+    unittest.main()
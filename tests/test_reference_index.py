@@ -0,0 +1,122 @@
+"""Tests for reference_index.py"""
+
+import os
+import tempfile
+import unittest
+
+from reference_index import (tokenize,
+                             record_from_reference,
+                             ReferenceIndex,
+                             MATCH_THRESHOLD)
+from reference_utils import Reference
+
+ZAMOLODCHIKOV = {"doi": "10.1016/0550-3213(90)90333-9",
+                 "arxiv_id": None,
+                 "title": "Thermodynamic Bethe ansatz in relativistic models: Scaling 3-state potts and Lee-Yang models",
+                 "first_author": "Zamolodchikov",
+                 "journal": "Nuclear Physics B",
+                 "short_journal": "Nucl. Phys. B",
+                 "volume": "342",
+                 "page": "695",
+                 "year": 1990}
+MEHENDALE = {"doi": None,
+             "arxiv_id": "0705.0100v5",
+             "title": "On Hadwiger Conjecture",
+             "first_author": "Mehendale",
+             "journal": None,
+             "short_journal": None,
+             "volume": None,
+             "page": None,
+             "year": "2007"}
+ZAMOLODCHIKOV_REFERENCE = ("\\bibitem{tba1} A.~Zamolodchikov, \\newblock {``Thermodynamic Bethe ansatz in relativistic models. "
+                           "Scaling   three state Potts and Lee-Yang models''}, \\newblock Nucl. Phys. B {\\bf 342}, 695--720 (1990).")
+
+
+class TestReferenceIndex(unittest.TestCase):
+    def setUp(self):
+        self.reference_index = ReferenceIndex()
+        self.reference_index.add(ZAMOLODCHIKOV)
+        self.reference_index.add(MEHENDALE)
+        # Add some other records, so the weights of the tokens differ.
+        for i in range(10):
+            self.reference_index.add({"doi": f"10.1234/{i}", "arxiv_id": None, "title": f"Scaling of models {i}",
+                                      "first_author": "Smith", "journal": "Nuclear Physics B", "short_journal": "Nucl. Phys. B",
+                                      "volume": str(i), "page": str(100 + i), "year": 1990})
+
+    def test_tokenization(self):
+        """Test that text is split into normalized words and numbers."""
+        self.assertEqual(tokenize("A.~Zamolodchikov, {\\bf 342}, 695--720 (1990)"), ["zamolodchikov", "342", "695", "720", "1990"])
+        self.assertEqual(tokenize("J.-S. Caux and the Bethe ansatz"), ["caux", "bethe", "ansatz"])
+        self.assertEqual(tokenize("Jérôme \\textit{Viti}"), ["jerome", "viti"])
+
+    def test_duplicates(self):
+        """Test that a record with the same DOI or arXiv id is only added once."""
+        self.assertEqual(len(self.reference_index), 12)
+        self.assertFalse(self.reference_index.add(dict(ZAMOLODCHIKOV)))
+        self.assertEqual(len(self.reference_index), 12)
+
+    def test_search(self):
+        """Test that free text references are matched to the right record, and that unknown references are not."""
+        record, confidence = self.reference_index.search(ZAMOLODCHIKOV_REFERENCE)
+        self.assertEqual(record, ZAMOLODCHIKOV)
+        self.assertGreaterEqual(confidence, MATCH_THRESHOLD)
+        record, confidence = self.reference_index.search("D. P. Mehendale, On Hadwiger's conjecture (2007)")
+        self.assertEqual(record, MEHENDALE)
+        self.assertGreaterEqual(confidence, MATCH_THRESHOLD)
+        # Only matching the journal and year is not enough.
+        record, confidence = self.reference_index.search("J. Doe, Something else entirely, Nucl. Phys. B 512, 3 (1990).")
+        self.assertLess(confidence, MATCH_THRESHOLD)
+        self.assertEqual(self.reference_index.search("J. Dubail, private communications."), (None, 0))
+
+    def test_different_work(self):
+        """Test that a record does not match a longer reference to a different work with the same author and title words."""
+        record, confidence = self.reference_index.search("D. P. Mehendale, A counterexample to the Hadwiger conjecture "
+                                                         "for infinite graphs, J. Graph Theory 12, 345 (2007).")
+        self.assertLess(confidence, MATCH_THRESHOLD)
+        # The volume, page and year of a record have to appear in a reference with numbers.
+        record, confidence = self.reference_index.search(ZAMOLODCHIKOV_REFERENCE.replace("(1990)", "(1991)"))
+        self.assertNotEqual(record, ZAMOLODCHIKOV)
+        record, confidence = self.reference_index.search("D. P. Mehendale, On Hadwiger conjecture, J. Graph Theory 12, 345 (2007).")
+        self.assertIsNone(record)
+
+    def test_index_file(self):
+        """Test that records are stored in the index file as soon as they are added, and found when it is opened again."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index_file = os.path.join(temp_dir, "index.sqlite")
+            reference_index = ReferenceIndex(index_file)
+            self.assertTrue(reference_index.add(ZAMOLODCHIKOV))
+            other_index = ReferenceIndex(index_file)
+            self.assertFalse(other_index.add(ZAMOLODCHIKOV))
+            self.assertEqual(other_index.add_records([MEHENDALE, MEHENDALE]), 1)
+            other_index.close()
+            self.assertEqual(len(reference_index), 2)
+            self.assertEqual(reference_index.search(ZAMOLODCHIKOV_REFERENCE)[0], ZAMOLODCHIKOV)
+            reference_index.close()
+
+    def test_reference_records(self):
+        """Test that only references which have been looked up are turned into records."""
+        reference = Reference("\\bibitem{Mehendale}, \\emph{On Hadwiger Conjecture}, https://arxiv.org/abs/0705.0100v5")
+        self.assertIsNone(record_from_reference(reference))
+        reference.arxiv_id = "0705.0100v5"
+        reference.arxiv_data = "<feed></feed>"
+        reference.title = "On Hadwiger Conjecture"
+        reference.full_authors = ["Dhananjay P. Mehendale"]
+        reference.year = "2007"
+        self.assertEqual(record_from_reference(reference), MEHENDALE)
+
+    def test_identifier_from_index(self):
+        """Test that references without a DOI or arXiv id get the identifiers of a matching record."""
+        reference = Reference(ZAMOLODCHIKOV_REFERENCE, reference_index=self.reference_index)
+        reference.reformatted_original_reference = ZAMOLODCHIKOV_REFERENCE
+        reference.find_in_index()
+        self.assertEqual(reference.doi, ZAMOLODCHIKOV["doi"])
+        self.assertGreaterEqual(reference.index_confidence, MATCH_THRESHOLD)
+        reference = Reference("\\bibitem{JDprivate} J. Dubail, private communications.", reference_index=self.reference_index)
+        reference.reformatted_original_reference = reference.bibitem_data
+        reference.find_in_index()
+        self.assertIsNone(reference.doi)
+        self.assertIsNone(reference.index_confidence)
+
+
+if __name__ == "__main__":
+    unittest.main(buffer=True, verbosity=2)
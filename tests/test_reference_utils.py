@@ -1,17 +1,28 @@
 """Test cases for the file reference_utils.py"""
 
+import io
+import json
 import unittest
+from unittest import mock
+
+import requests
 
 from reference_utils import (abbreviate_authors,
                              get_first_author_last_name,
                              extract_bibtex_items,
+                             extract_bibtex_item_spans,
                              extract_bibitem_identifier,
                              extract_doi,
+                             extract_dois,
                              extract_arxiv_id,
+                             extract_arxiv_ids,
+                             split_bibitem,
                              reformat_original_reference,
                              concatenate_authors,
                              remove_arxiv_id_version,
-                             Reference)
+                             Reference,
+                             write_reference_records)
+from concurrency import Deadline
 
 
 class TestReferenceUtils(unittest.TestCase):
@@ -69,6 +80,13 @@ class TestReferenceUtils(unittest.TestCase):
                           "\\bibitem{Frietrans} D. Friedan, ``Entropy flow in near-critical quantum circuits'', "
                           "J Stat Phys (2017) \\\\ DOI: 10.1007/s10955-017-1751-9\n\n"])
 
+    def test_bibtex_item_span_extraction(self):
+        """Test that the positions of bibtex items in a string are correctly extracted."""
+        latex_source = "\\begin{thebibliography}{9}\n\\bibitem{a} A.\n%\\bibitem{b} B.\n\\bibitem{c} C.\n\\end{thebibliography}"
+        spans = extract_bibtex_item_spans(latex_source)
+        self.assertEqual([latex_source[start:end] for start, end in spans], extract_bibtex_items(latex_source))
+        self.assertEqual(spans, [(27, 43), (58, 73)])
+
     def test_doi_extraction(self):
         """Test that DOI's are correctly extracted from a string."""
         self.assertEqual(extract_doi("Hello"), None)
@@ -90,6 +108,30 @@ class TestReferenceUtils(unittest.TestCase):
         self.assertEqual(extract_arxiv_id("arXiv:1608.02869]"), "1608.02869")
         self.assertEqual(extract_arxiv_id("\eprint{1608.02869}"), "1608.02869")
 
+    def test_multiple_identifier_extraction(self):
+        """Test that all DOI's and arXiv id's are extracted from a string, in order."""
+        self.assertEqual(extract_dois("Hello"), [])
+        self.assertEqual(extract_dois("\\doi{10.1103/PhysRevA.81.013826}; \\doi{10.1063/1.3216474}; \\doi{10.1063/1.3216108}."),
+                         ["10.1103/PhysRevA.81.013826", "10.1063/1.3216474", "10.1063/1.3216108"])
+        self.assertEqual(extract_arxiv_ids("Hello"), [])
+        self.assertEqual(extract_arxiv_ids("arXiv:1608.02869 and https://arxiv.org/abs/0705.0100v5 and \\eprint{cond-mat/0312250}"),
+                         ["1608.02869", "0705.0100v5", "cond-mat/0312250"])
+
+    def test_bibitem_splitting(self):
+        """Test that bibitems with multiple references are split into the individual references."""
+        self.assertEqual(split_bibitem("\\bibitem{test} \\doi{10.1103/PhysRevA.81.013826}; \\doi{10.1063/1.3216474}; \\doi{10.1063/1.3216108}."),
+                         ["\\bibitem{test} \\doi{10.1103/PhysRevA.81.013826}", "\\doi{10.1063/1.3216474}", "\\doi{10.1063/1.3216108}."])
+        self.assertEqual(split_bibitem("\\bibitem{a} X, PRB 1, arXiv:1608.02869 ; Y, PRL 2, \\doi{10.1063/1.3216474}"),
+                         ["\\bibitem{a} X, PRB 1, arXiv:1608.02869", "Y, PRL 2, \\doi{10.1063/1.3216474}"])
+        # Parts without an identifier stay with the preceding reference.
+        self.assertEqual(split_bibitem("\\bibitem{a} X; Y, PRB 1; \\doi{10.1063/1.3216474}; see also Z"),
+                         ["\\bibitem{a} X; Y, PRB 1; \\doi{10.1063/1.3216474}; see also Z"])
+        self.assertEqual(split_bibitem("%%CITATION = doi:10.1007/JHEP09(2016)144;%%\n  %3 citations counted in INSPIRE as of 13 Apr 2017"),
+                         ["%%CITATION = doi:10.1007/JHEP09(2016)144;%%\n  %3 citations counted in INSPIRE as of 13 Apr 2017"])
+        # Semicolons inside a DOI are not split on.
+        self.assertEqual(split_bibitem("\\doi{10.1002/(SICI)1097-4636(199605)31:1<1::AID-JBM1>3.0.CO;2-T}; \\doi{10.1063/1.3216474}"),
+                         ["\\doi{10.1002/(SICI)1097-4636(199605)31:1<1::AID-JBM1>3.0.CO;2-T}", "\\doi{10.1063/1.3216474}"])
+
     def test_original_reference_reformatting(self):
         """Test reformatting of original references."""
         self.assertEqual(reformat_original_reference("\\bibitem{tba1} A.~Zamolodchikov, \\newblock "
@@ -204,6 +246,90 @@ class TestReferenceClass(unittest.TestCase):
         self.assertEqual(reference.formatted_reference, "D. P. Mehendale, \\textit{On Hadwiger Conjecture}, "
                          "\href{https://arxiv.org/abs/0705.0100v5}{arXiv:0705.0100v5}. % Has this been published somewhere?")
 
+    def test_expired_deadline(self):
+        """Test that no lookups are done once the deadline has passed, and that this is recorded."""
+        reference = Reference("\\bibitem{tba1} Nucl. Phys. B {\\bf 342}, 695--720 (1990). \\\\ DOI: 10.1016/0550-3213(90)90333-9",
+                              deadline=Deadline(0))
+        reference.main()
+        self.assertTrue(reference.deadline_exceeded)
+        self.assertIsNone(reference.crossref_data)
+        self.assertEqual(reference.doi, "10.1016/0550-3213(90)90333-9")
+
+    def test_reference_records(self):
+        """Test that the status and record of a reference reflect the outcome of the lookup, without network access."""
+        reference = Reference("\\bibitem{JDprivate} J. Dubail, private communications.")
+        reference.main()
+        self.assertEqual(reference.status(), "no_identifier")
+        record = reference.record()
+        self.assertEqual(record["bibitem_identifier"], "JDprivate")
+        self.assertEqual(record["status"], "no_identifier")
+        self.assertIsNotNone(record["lookup_time"])
+        self.assertNotIn("sub_references", record)
+        reference = Reference("\\bibitem{test} \\doi{10.1103/PhysRevA.81.013826}; arXiv:1608.02869", deadline=Deadline(0))
+        reference.main()
+        self.assertEqual(reference.status(), "deadline_exceeded")
+        self.assertEqual([r["arxiv_id"] for r in reference.record()["sub_references"]], [None, "1608.02869"])
+
+    def test_transient_errors(self):
+        """Test that a reference records whether its lookup failed on an error which may go away."""
+        not_found = requests.Response()
+        not_found.status_code, not_found.reason, not_found.url = 404, "Not Found", "https://api.crossref.org/works/10.1234/typo"
+        for response, transient_error in [(not_found, False), (requests.exceptions.ConnectionError(), True)]:
+            with mock.patch("requests.get", side_effect=[response]):
+                reference = Reference("\\bibitem{typo} A. Author, \\doi{10.1234/typo}.")
+                reference.main()
+            self.assertEqual(reference.status(), "failed")
+            self.assertEqual(reference.record()["transient_error"], transient_error)
+
+    def test_reference_record_writing(self):
+        """Test that a JSON record is written for every bibitem, with its position in the input."""
+        output = io.StringIO()
+        bibtex_entries = ["\\bibitem{a} First.", "\\bibitem{b} Second."]
+
+        def lookup_reference(bibtex_entry):
+            reference = Reference(bibtex_entry)
+            reference.main()
+            return reference
+
+        write_reference_records(lookup_reference, bibtex_entries, output, spans=[(0, 18), (18, 37)])
+        records = sorted((json.loads(line) for line in output.getvalue().splitlines()), key=lambda record: record["index"])
+        self.assertEqual([(r["index"], r["bibitem_identifier"], r["source_span"]) for r in records], [(0, "a", [0, 18]), (1, "b", [18, 37])])
+        self.assertEqual(records[0]["reformatted_original_reference"], "First.")
+
+    def test_sub_references(self):
+        """Test that the references in a single bibitem are looked up separately and joined in order, without the network."""
+        crossref_response = mock.Mock()
+        crossref_response.json.return_value = {"message": {
+            "type": "journal-article", "author": [{"given": "Jean-Sébastien", "family": "Caux"}],
+            "title": ["Correlation functions of integrable models"], "container-title": ["Journal of Mathematical Physics"],
+            "short-container-title": ["J. Math. Phys."], "volume": "50", "page": "095214", "issued": {"date-parts": [[2009]]}}}
+        arxiv_response = mock.Mock(text="<feed><entry><title>Tomography of photons</title><published>2010-01-15</published>"
+                                        "<summary>Abstract.</summary><author><name>Ulf Schilling</name></author></entry></feed>")
+
+        def get(address, timeout):
+            # The sub-references are looked up concurrently, so the responses depend on the address, not the order.
+            if "10.1063/1.3216474" in address:
+                return crossref_response
+            if "1001.00001" in address:
+                return arxiv_response
+            raise requests.exceptions.ConnectionError(address)
+
+        with mock.patch("requests.get", side_effect=get):
+            reference = Reference("\\bibitem{test} arXiv:1001.00001; \\doi{10.1063/1.3216474}; \\doi{10.1234/missing}.")
+            reference.main()
+        self.assertEqual([sub_reference.bibitem_data for sub_reference in reference.sub_references],
+                         ["\\bibitem{test} arXiv:1001.00001", "\\doi{10.1063/1.3216474}", "\\doi{10.1234/missing}."])
+        # The comment of the arXiv reference is moved to the end, so it does not comment out the other references.
+        self.assertEqual(reference.formatted_reference,
+                         "U. Schilling, \\textit{Tomography of photons}, \\href{https://arxiv.org/abs/1001.00001}{arXiv:1001.00001}; "
+                         "J.-S. Caux, \\textit{Correlation functions of integrable models}, J. Math. Phys. \\textbf{50}, 095214 (2009), "
+                         "\\doi{10.1063/1.3216474}; AUTHORS, \\textit{TITLE}, JOURNAL \\textbf{VOLUME}, PAGE/ARTICLE NUMBER (YEAR), "
+                         "\\doi{DOI}. % Has this been published somewhere?")
+        self.assertEqual((reference.bibitem_identifier, reference.arxiv_id), ("test", "1001.00001"))
+        record = reference.record()
+        self.assertEqual((record["status"], record["transient_error"]), ("partially_resolved", True))
+        self.assertEqual([sub_record["status"] for sub_record in record["sub_references"]], ["resolved", "resolved", "failed"])
+
     def test_multiple_references(self):
         """Test that the inclusion of multiple references under a single bibitem is correctly handled."""
         reference = Reference("\\bibitem{test} \\doi{10.1103/PhysRevA.81.013826}; \doi{10.1063/1.3216474}; \doi{10.1063/1.3216108}.")
@@ -0,0 +1,51 @@
+"""Tests for the cold-start time of the command line tools."""
+
+import os
+import subprocess
+import sys
+import unittest
+
+# Maximum cumulative import time (in microseconds) for a command line tool.
+IMPORT_TIME_BUDGET = 100000
+# Dependencies which should only be imported when a reference is actually looked up.
+HEAVY_MODULES = ["bs4", "requests", "html5lib", "multiprocessing", "sqlite3"]
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_import_times(module):
+    """Import a module in a fresh interpreter and return the cumulative import time of every imported module."""
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=REPOSITORY_ROOT, stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+    import_times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        import_times[name.strip()] = int(cumulative)
+    return import_times
+
+
+class TestStartup(unittest.TestCase):
+    def check_startup(self, module):
+        import_times = measure_import_times(module)
+        for heavy_module in HEAVY_MODULES:
+            self.assertNotIn(heavy_module, import_times, f"{module} imports {heavy_module} at startup.")
+        self.assertLess(import_times[module], IMPORT_TIME_BUDGET,
+                        f"Importing {module} took {import_times[module]} us, the budget is {IMPORT_TIME_BUDGET} us.")
+
+    def test_reference_formatter_startup(self):
+        """Test that the reference formatter starts without importing heavy dependencies."""
+        self.check_startup("reference_formatter")
+
+    def test_reference_scraper_startup(self):
+        """Test that the reference scraper starts without importing heavy dependencies."""
+        self.check_startup("reference_scraper")
+
+    def test_help(self):
+        """Test that the help message of the command line tools is shown without errors."""
+        for script in ["reference_formatter.py", "reference_scraper.py"]:
+            subprocess.run([sys.executable, script, "--help"], cwd=REPOSITORY_ROOT, stdout=subprocess.PIPE, check=True)
+
+
+if __name__ == "__main__":
+    unittest.main(buffer=True, verbosity=2)